@@ -0,0 +1,408 @@
+"""
+Benchmarks for the drawing engine of paint.py (paint_engine).
+The engine needs no window; the SDL dummy video driver is set anyway.
+
+Usage: python benchmark.py [--json results.json] [--baseline baseline.json] [--threshold 0.1]
+"""
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import argparse
+import json
+import platform
+import time
+from typing import Callable
+
+import numpy as np
+import pygame
+
+import paint_engine
+
+SEGMENT_LENGTHS = (10, 50, 100, 250, 500, 1000)
+BRUSH_RADII = (4, 6, 8, 10)
+HISTORY_CANVAS_SIZES = ((800, 600), (2000, 2000), (8000, 6000))
+REGRESSION_THRESHOLD = 0.10  # Slowdown against the baseline reported as a regression
+RESULTS_VERSION = 1
+
+
+def best_time(function: Callable[[], None], repeats: int = 5) -> float:
+    """Returns the fastest of several runs of function, in seconds."""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def stroke_mask(method: str, start, end, radius: int, size=(400, 400)) -> np.ndarray:
+    """Draws one segment with a Brush stroke method on a blank canvas and returns the painted pixels."""
+    canvas = paint_engine.Canvas(*size)
+    brush = paint_engine.Brush(size=radius, color=(0, 0, 0))
+    brush.last_position = start
+    getattr(brush, method)(canvas, end)
+    # round_line_stamps leaves the caps to Brush.draw, which stamps both ends
+    canvas.draw_circle(brush.color, start, radius)
+    canvas.draw_circle(brush.color, end, radius)
+    return canvas.snapshot() != canvas.background_value
+
+
+def _grow(mask: np.ndarray) -> np.ndarray:
+    """Dilates a mask by one pixel (4-neighbourhood)."""
+    grown = mask.copy()
+    grown[1:] |= mask[:-1]
+    grown[:-1] |= mask[1:]
+    grown[:, 1:] |= mask[:, :-1]
+    grown[:, :-1] |= mask[:, 1:]
+    return grown
+
+
+def edge_deviation(reference: np.ndarray, candidate: np.ndarray, limit: int = 10) -> int:
+    """
+    Returns how far (in px, up to limit) the differing pixels of candidate
+    lie from the edge of reference: 0 when identical.
+    """
+    outside, inside = reference, ~reference
+    for distance in range(limit + 1):
+        extra = candidate & ~outside
+        missing = reference & ~candidate & ~inside
+        if not extra.any() and not missing.any():
+            return distance
+        outside, inside = _grow(outside), _grow(inside)
+    return limit
+
+
+def bench_stroke_tolerance(samples: int = 200) -> int:
+    """Compares capsule strokes against stamped strokes on random segments; returns the worst deviation."""
+    rng = np.random.default_rng(0)
+    worst = 0
+    for _ in range(samples):
+        radius = int(rng.choice(BRUSH_RADII))
+        start, end = (tuple(int(v) for v in rng.integers(50, 350, 2)) for _ in range(2))
+        reference = stroke_mask("round_line_stamps", start, end, radius)
+        candidate = stroke_mask("round_line", start, end, radius)
+        worst = max(worst, edge_deviation(reference, candidate))
+    return worst
+
+
+def recorded_canvas(size: int = 2048) -> paint_engine.Canvas:
+    """
+    A canvas painted over its middle and not committed, so the undo copies of
+    the tiles under the timed strokes are already taken. The UI copies a tile
+    once per action, on the first segment that touches it: timing the later
+    segments leaves that one-off copy out.
+    """
+    canvas = paint_engine.Canvas(size, size)
+    canvas.draw_circle((0, 0, 0), (size // 2, size // 2), size // 2)
+    return canvas
+
+
+def bench_segments(radius: int = 10) -> list:
+    """Time per segment of the stamped and capsule strokes, for several segment lengths."""
+    canvas = recorded_canvas()
+    brush = paint_engine.Brush(size=radius, color=(0, 0, 0))
+    rows = []
+    for length in SEGMENT_LENGTHS:
+        timings = {}
+        for method in ("round_line_stamps", "round_line"):
+            def stroke():
+                brush.last_position = (500, 500)
+                getattr(brush, method)(canvas, (500 + length, 500 + length // 2))
+                brush.take_dirty_rects()
+            timings[method] = best_time(stroke)
+        rows.append((length, timings["round_line_stamps"], timings["round_line"]))
+    return rows
+
+
+def bench_frame_samples(radius: int = 10, samples=(1, 4, 16, 64)) -> list:
+    """Time to draw one frame's mouse samples: one Brush.draw per sample against one Brush.draw_polyline."""
+    canvas = paint_engine.Canvas(2048, 2048)
+    brush = paint_engine.Brush(size=radius, color=(0, 0, 0))
+    canvas.draw_circle(brush.color, (1024, 1024), 1024)
+    rows = []
+    for count in samples:
+        points = [(500 + 6 * i, 500 + (3 * i) % 40) for i in range(1, count + 1)]
+
+        def per_sample():
+            brush.enable_last_position, brush.last_position = True, (500, 500)
+            for point in points:
+                brush.draw(canvas, point)
+            brush.take_dirty_rects()
+
+        def polyline():
+            brush.enable_last_position, brush.last_position = True, (500, 500)
+            brush.draw_polyline(canvas, points)
+            brush.take_dirty_rects()
+
+        rows.append((count, best_time(per_sample), best_time(polyline)))
+    return rows
+
+
+def draw_circle_uncached(canvas: paint_engine.Canvas, color, center, radius: int) -> None:
+    """Rasterizes a circle with pygame.draw.circle on every tile under it (no stamp cache)."""
+    bounds = pygame.Rect(center[0] - radius, center[1] - radius, 2 * radius + 1, 2 * radius + 1)
+    for key in canvas.tile_keys(bounds):
+        tile_rect = canvas.tile_rect(key)
+        pygame.draw.circle(canvas._writable(key), color, (center[0] - tile_rect.x, center[1] - tile_rect.y), radius)
+
+
+def bench_stamps(count: int = 2000) -> list:
+    """Stamps per second for the brush sizes of the UI: uncached circles, cached stamps, batched stamps, rainbow colors."""
+    canvas = paint_engine.Canvas(1024, 1024)
+    brush = paint_engine.Brush()
+    centers = [(100 + i % 800, 100 + (i * 7) % 800) for i in range(count)]
+    rows = []
+    for radius in BRUSH_RADII:
+        def uncached():
+            for center in centers:
+                draw_circle_uncached(canvas, (0, 0, 0), center, radius)
+
+        def cached():
+            for center in centers:
+                canvas.draw_circle((0, 0, 0), center, radius)
+
+        def batched():
+            canvas.draw_stamps((0, 0, 0), centers, radius)
+
+        def rainbow():
+            for center in centers:
+                brush.color_value = (brush.color_value + 8) % (256 * 6)
+                canvas.draw_circle(brush.rainbowColor(), center, radius)
+
+        rows.append((radius, *(count / best_time(function) for function in (uncached, cached, batched, rainbow))))
+    return rows
+
+
+def per_call(function: Callable[[], None], calls: int, repeats: int = 5) -> float:
+    """Seconds per call, for a function that makes calls operations, from its fastest run."""
+    return best_time(function, repeats) / calls
+
+
+def maze_pixels(cells: int = 128, corridor: int = 3) -> np.ndarray:
+    """A random perfect maze as an RGB image: white corridors corridor px wide, all connected, between black walls."""
+    rng = np.random.default_rng(0)
+    grid = np.zeros((2 * cells + 1, 2 * cells + 1), dtype=bool)
+    grid[1, 1] = True
+    visited, stack = {(0, 0)}, [(0, 0)]
+    while stack:
+        x, y = stack[-1]
+        options = [(x + dx, y + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))
+                   if 0 <= x + dx < cells and 0 <= y + dy < cells and (x + dx, y + dy) not in visited]
+        if not options:
+            stack.pop()
+            continue
+        nx, ny = options[rng.integers(len(options))]
+        grid[2 * ny + 1, 2 * nx + 1] = grid[y + ny + 1, x + nx + 1] = True
+        visited.add((nx, ny))
+        stack.append((nx, ny))
+    grid = grid.repeat(corridor, axis=0).repeat(corridor, axis=1)
+    return np.where(grid[..., None], 255, 0).astype(np.uint8).repeat(3, axis=2)
+
+
+def checkerboard_pixels(size: int = 512) -> np.ndarray:
+    """A one pixel black and white checkerboard: a single 8-connected region of half the pixels."""
+    board = (np.indices((size, size)).sum(axis=0) % 2).astype(bool)
+    return np.where(board[..., None], 255, 0).astype(np.uint8).repeat(3, axis=2)
+
+
+def bench_flood_fill() -> dict:
+    """Brush.floodFill on an empty canvas, a maze and a checkerboard (8-connected, the worst case)."""
+    cases = (
+        ("empty_2000x2000", paint_engine.Canvas(2000, 2000), (0, 0), 4),
+        ("maze_771x771", paint_engine.Canvas.from_array(maze_pixels()), (4, 4), 4),
+        ("checkerboard_512x512", paint_engine.Canvas.from_array(checkerboard_pixels()), (0, 0), 8),
+    )
+    results = {}
+    for name, canvas, seed, connectivity in cases:
+        brush = paint_engine.Brush()
+        original = tuple(canvas.get_at(seed))[:3]
+        colors = [original, (255, 0, 0)]
+
+        def fill():
+            # Alternate colors so every fill repaints the same region
+            colors.reverse()
+            brush.floodFill(canvas, seed, colors[0], 0, connectivity)
+            canvas.discard_history()
+
+        results[f"flood_fill/{name}"] = per_call(fill, 1, repeats=7)
+    return results
+
+
+def check_fill_bounds(size=(300, 300)) -> bool:
+    """Whether fills seeded just off each edge of a canvas change nothing and return None."""
+    canvas = paint_engine.Canvas(*size)
+    width, height = size
+    blank = canvas.digest()
+    outside = ((-1, 100), (width, 100), (100, -1), (100, height), (width + 100, 100), (100, height + 100))
+    return all(canvas.flood_fill(position, (255, 0, 0)) is None for position in outside) and canvas.digest() == blank
+
+
+def bench_round_line(lengths=(10, 100, 1000), calls: int = 20) -> dict:
+    """Brush.round_line for every brush size of the UI and several segment lengths (see recorded_canvas)."""
+    canvas = recorded_canvas()
+    results = {}
+    for radius in BRUSH_RADII:
+        brush = paint_engine.Brush(size=radius, color=(0, 0, 0))
+        for length in lengths:
+            def strokes():
+                for _ in range(calls):
+                    brush.last_position = (500, 500)
+                    brush.round_line(canvas, (500 + length, 500 + length // 2))
+                brush.take_dirty_rects()
+            results[f"round_line/r{radius}/len{length}"] = per_call(strokes, calls)
+    return results
+
+
+def bench_rainbow_color(calls: int = 10000) -> dict:
+    """Brush.rainbowColor over a whole color cycle."""
+    brush = paint_engine.Brush()
+
+    def colors():
+        for i in range(calls):
+            brush.color_value = (i * 8) % (256 * 6)
+            brush.rainbowColor()
+
+    return {"rainbow_color": per_call(colors, calls)}
+
+
+def bench_history(repeats: int = 9) -> dict:
+    """Undo push (take the changed tiles, store them) and pop (capture for redo, restore) after a diagonal stroke."""
+    results = {}
+    for width, height in HISTORY_CANVAS_SIZES:
+        canvas = paint_engine.Canvas(width, height)
+        store = paint_engine.HistoryStore()
+        pushes, pops = [], []
+        for i in range(repeats):
+            canvas.draw_capsule((i * 40 % 256, 0, 0), (0, 0), (width - 1, height - 1), 10)
+            start = time.perf_counter()
+            store.push(canvas.take_history_entry())
+            pushes.append(time.perf_counter() - start)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            entry = store.pop()
+            canvas.capture(entry)
+            canvas.restore(entry)
+            pops.append(time.perf_counter() - start)
+        results[f"history/push/{width}x{height}"] = min(pushes)
+        results[f"history/pop/{width}x{height}"] = min(pops)
+    return results
+
+
+def bench_buttons(calls: int = 200) -> dict:
+    """RectButton.draw (cached image), RectButton.render (uncached) and ButtonManager.draw_all on a toolbar."""
+    import paint  # The UI module; only its button classes are used, no window is opened
+    pygame.font.init()
+    font = paint.get_font("segoeuisymbol", 30)
+    manager = paint.ButtonManager()
+    for i, text in enumerate(("SAVE", "OPEN", "CANC", "FILL", "RGB", "↩", "↪", "🎨", "HSV")):
+        manager.add(paint.RectButton(x=10 + 110 * i, y=10, width=100, height=50, color=(200, 200, 200), text=text, font=font))
+    surface = pygame.Surface((1280, 70))
+    button = manager.buttons[0]
+
+    def draw():
+        for _ in range(calls):
+            button.draw(surface)
+
+    def render():
+        for _ in range(calls):
+            button.render()
+
+    def draw_all():
+        for _ in range(calls):
+            manager.draw_all(surface)
+
+    return {
+        "button/draw": per_call(draw, calls),
+        "button/render": per_call(render, calls),
+        "button_manager/draw_all": per_call(draw_all, calls),
+    }
+
+
+def bench_hot_paths() -> dict:
+    """Seconds per operation for every engine hot path, by name."""
+    results = {}
+    for bench in (bench_flood_fill, bench_round_line, bench_rainbow_color, bench_history, bench_buttons):
+        results.update(bench())
+    return results
+
+
+def write_results(path: str, results: dict) -> None:
+    """Write the hot path timings as JSON, with the environment they were measured in."""
+    with open(path, "w") as file:
+        json.dump({
+            "version": RESULTS_VERSION,
+            "unit": "seconds per operation",
+            "python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "machine": platform.machine(),
+            "results": results,
+        }, file, indent=2, sort_keys=True)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Rows (name, seconds, baseline seconds or None, relative change or None, regressed)
+    for every result; a result regressed when it is more than threshold slower.
+    """
+    rows = []
+    for name, seconds in sorted(results.items()):
+        base = baseline.get(name)
+        change = None if not base else seconds / base - 1
+        rows.append((name, seconds, base, change, change is not None and change > threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the drawing engine of paint.py.")
+    parser.add_argument("--radius", type=int, default=10, help="brush radius for the segment timings")
+    parser.add_argument("--json", metavar="PATH", help="write the hot path timings to PATH as JSON")
+    parser.add_argument("--baseline", metavar="PATH", help="compare the hot path timings with a JSON file written by --json")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="relative slowdown against the baseline counted as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    print(f"Stroke segments (radius {args.radius}), ms per segment")
+    print(f"{'length':>8} {'stamps':>10} {'capsule':>10} {'speedup':>8}")
+    for length, stamps, capsule in bench_segments(args.radius):
+        print(f"{length:>8} {stamps * 1000:>10.3f} {capsule * 1000:>10.3f} {stamps / capsule:>7.1f}x")
+
+    print(f"\nMouse samples per frame (radius {args.radius}), ms per frame")
+    print(f"{'samples':>8} {'per-sample':>10} {'polyline':>10} {'speedup':>8}")
+    for count, per_sample, polyline in bench_frame_samples(args.radius):
+        print(f"{count:>8} {per_sample * 1000:>10.3f} {polyline * 1000:>10.3f} {per_sample / polyline:>7.1f}x")
+
+    print("\nBrush stamps per second")
+    print(f"{'radius':>8} {'uncached':>10} {'cached':>10} {'batched':>10} {'rainbow':>10}")
+    for radius, uncached, cached, batched, rainbow in bench_stamps():
+        print(f"{radius:>8} {uncached:>10.0f} {cached:>10.0f} {batched:>10.0f} {rainbow:>10.0f}")
+
+    worst = bench_stroke_tolerance()
+    status = "ok" if worst <= paint_engine.STROKE_TOLERANCE else "FAILED"
+    print(f"\nCapsule vs stamped strokes: max edge deviation {worst} px "
+          f"(tolerance {paint_engine.STROKE_TOLERANCE} px) {status}")
+
+    fill_bounds = check_fill_bounds()
+    print(f"Flood fill seeded off the canvas: {'ok' if fill_bounds else 'FAILED'}")
+
+    results = bench_hot_paths()
+    if args.json:
+        write_results(args.json, results)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+    rows = compare(results, baseline, args.threshold)
+    print("\nEngine hot paths, µs per operation")
+    print(f"{'name':<36} {'time':>10} {'baseline':>10} {'change':>8}")
+    for name, seconds, base, change, regressed in rows:
+        base_text = f"{base * 1e6:>10.1f}" if base else f"{'-':>10}"
+        change_text = f"{change:>+8.1%}" if change is not None else f"{'-':>8}"
+        print(f"{name:<36} {seconds * 1e6:>10.1f} {base_text} {change_text}{'  REGRESSION' if regressed else ''}")
+    regressions = sum(row[-1] for row in rows)
+    if baseline:
+        print(f"\n{regressions} regression(s) over {args.threshold:.0%} against {args.baseline}")
+    return 0 if worst <= paint_engine.STROKE_TOLERANCE and fill_bounds and not regressions else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
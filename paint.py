@@ -1,160 +1,308 @@
+import time
+STARTUP_TIME = time.perf_counter()  # Taken before the heavy imports, for --profile-startup
+
+import argparse
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import colorsys
 from copy import deepcopy
 from dataclasses import dataclass, field
+from functools import lru_cache, wraps
+import json
 import os
-from typing import Tuple, Optional, Callable, List
+import threading
+from typing import ClassVar, Tuple, Optional, Callable, List
+import numpy as np
 import pygame
 import sys
-from tkinter import Tk, filedialog, messagebox
-from PIL import Image
 
-pygame.init()
-pygame.font.init()
+# The drawing engine (canvas, brush, fill, history, command logs) works without a window
+from paint_engine import (
+    FILL_TOLERANCE_STEP, FILL_TOLERANCE_MAX, HISTORY_MEMORY_BUDGET, HistoryEntry, HistoryStore,
+    Canvas, Brush, PNG_COMPRESSION_LEVEL, PNG_FILTERS, image_size, fitted_size, load_image, load_preview,
+    COMMAND_LOG_EXTENSION, ClearCommand, ImageCommand, CommandLog,
+)
 
-# --- BRUSH CLASS ---
-@dataclass
-class Brush:
+# tkinter is imported where a dialog needs it, PIL where an image is decoded
+# (see load_image), and only the pygame subsystems the app uses are started (see UI.__init__).
+
+# Image types offered by the open dialog (formats pygame.image.load or PIL can decode)
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tga', '.tif', '.tiff', '.webp', '.pcx', '.pnm', '.ppm', '.pgm', '.pbm', '.xpm', '.lbm')
+
+
+# --- STARTUP PROFILER ---
+class StartupProfiler:
     """
-    Represents the drawing brush with configurable size, color, and drawing modes.
-    Supports normal drawing, fill mode, and rainbow mode.
+    Records the time spent in each startup phase up to the first frame.
+    When disabled, mark() returns immediately so normal launches pay nothing.
     """
-    size: int = field(default=8)
-    color: Tuple[int, int, int] = field(default=(0, 0, 0))
-    enable_last_position: bool = field(default=False, init=False)
-    last_position: Tuple[int, int] = field(default=(0,0), init=False)
-    fill: bool = field(default=False)       
-    rainbow: bool = field(default=False)
-    prev_color: Tuple[int, int, int] = None
+    def __init__(self, enabled: bool = False, start: float = STARTUP_TIME):
+        self.enabled = enabled
+        self.start = start
+        self._last = start
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str) -> None:
+        """End the phase running since the previous mark and record it under the given name."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self) -> str:
+        """Returns a table of the recorded phases and the total time to first frame."""
+        lines = ["Startup profile:"]
+        for phase, seconds in self.phases:
+            lines.append(f"  {phase:<16}{seconds * 1000:9.1f} ms")
+        lines.append(f"  {'total':<16}{(self._last - self.start) * 1000:9.1f} ms")
+        return "\n".join(lines)
+
+    def finish(self) -> None:
+        """Print the report once, after the first frame, and stop recording."""
+        if self.enabled:
+            print(self.report())
+            self.enabled = False
+
+
+# --- FRAME PROFILER ---
+FRAME_STATS_WINDOW = 120  # Frames in the rolling stats of the HUD
+HUD_LINES = 8  # Phases listed by the HUD
+HUD_LINE_HEIGHT = 18
+HUD_WIDTH = 300
+
+
+class _Span:
+    """Times a with block and hands it to the profiler."""
+    __slots__ = ("profiler", "name", "category", "start")
+
+    def __init__(self, profiler: 'FrameProfiler', name: str, category: str):
+        self.profiler, self.name, self.category = profiler, name, category
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.category, self.start, time.perf_counter())
+
+
+class _NoSpan:
+    """What span() returns when the profiler is off: does nothing."""
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
 
-    color_value: int = field(default=0, init=False)
+    def __exit__(self, *exc_info):
+        pass
 
-    def set_color(self, color):
-        """Set the brush color."""
-        self.color = color
 
-    def set_size(self, size):
-        """Set the brush size (radius in pixels)."""
-        self.size = size
+NO_SPAN = _NoSpan()
 
-    def floodFill(self, surface, position, fill_color):
+
+class FrameProfiler:
+    """
+    Times the phases of each frame of UI.run and the user actions, as spans.
+    Feeds rolling frame stats to the on-screen HUD and, with a trace path,
+    keeps every span for a Chrome trace / Perfetto JSON file. While neither
+    the HUD nor a trace is on, span() returns a shared no-op context and
+    the frame hooks return at once. Spans of the save and open threads
+    ("worker") go to the trace only, on the track of their thread.
+    """
+    def __init__(self, trace_path: Optional[str] = None, hud: bool = False, window: int = FRAME_STATS_WINDOW):
+        self.trace_path = trace_path
+        self.hud = hud
+        self.origin = time.perf_counter()
+        self.spans: List[Tuple[str, str, float, float, str]] = []
+        self.frame_times = deque(maxlen=window)
+        self.frame_starts = deque(maxlen=window)
+        self.phase_times = deque(maxlen=window)
+        self._frame_start = None
+        self._phases = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.hud or self.trace_path is not None
+
+    def span(self, name: str, category: str = "phase"):
+        """Context manager timing a phase (or an "action") of the current frame."""
+        return _Span(self, name, category) if self.enabled else NO_SPAN
+
+    def record(self, name: str, category: str, start: float, end: float) -> None:
+        """Add a finished span (from any thread: list.append is atomic)."""
+        if self.trace_path is not None:
+            self.spans.append((name, category, start, end - start, threading.current_thread().name))
+        if category == "phase":
+            self._phases[name] = self._phases.get(name, 0.0) + end - start
+
+    def begin_frame(self) -> None:
+        if not self.enabled:
+            self._frame_start = None
+            return
+        self._frame_start = time.perf_counter()
+        self._phases = {}
+
+    def end_frame(self) -> None:
+        """Close the frame (before waiting for the next one): its time goes into the rolling stats."""
+        if self._frame_start is None:
+            return
+        end = time.perf_counter()
+        self.frame_times.append(end - self._frame_start)
+        self.frame_starts.append(self._frame_start)
+        self.phase_times.append(self._phases)
+        if self.trace_path is not None:
+            self.spans.append(("frame", "frame", self._frame_start, end - self._frame_start,
+                               threading.current_thread().name))
+
+    def stats(self) -> dict:
+        """Rolling stats over the last frames: work time (ms) mean, p95 and max, frames per second and mean ms per phase."""
+        if not self.frame_times:
+            return {}
+        times = np.array(self.frame_times) * 1000
+        elapsed = self.frame_starts[-1] - self.frame_starts[0]
+        phases = {}
+        for frame in self.phase_times:
+            for name, seconds in frame.items():
+                phases[name] = phases.get(name, 0.0) + seconds * 1000 / len(self.phase_times)
+        return {
+            "mean_ms": float(times.mean()),
+            "p95_ms": float(np.percentile(times, 95)),
+            "max_ms": float(times.max()),
+            "fps": (len(self.frame_starts) - 1) / elapsed if elapsed > 0 else 0.0,
+            "phases": phases,
+        }
+
+    def hud_lines(self) -> List[str]:
+        """The text of the HUD."""
+        stats = self.stats()
+        if not stats:
+            return ["frame stats: waiting for frames"]
+        lines = [f"frame {stats['mean_ms']:.2f} ms  p95 {stats['p95_ms']:.2f}  max {stats['max_ms']:.2f}",
+                 f"{stats['fps']:.0f} fps over {len(self.frame_times)} frames"]
+        for name, ms in sorted(stats["phases"].items(), key=lambda item: -item[1])[:HUD_LINES]:
+            lines.append(f"  {name:<14}{ms:7.3f} ms")
+        return lines
+
+    def write_trace(self) -> None:
+        """Write the spans as Chrome trace events (load in chrome://tracing or ui.perfetto.dev), one track per thread."""
+        if self.trace_path is None:
+            return
+        threads = {}  # Thread name -> tid, numbered in order of appearance
+        for span in self.spans:
+            threads.setdefault(span[4], len(threads) + 1)
+        events = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": thread}}
+                  for thread, tid in threads.items()]
+        events += [{"name": name, "cat": category, "ph": "X", "pid": 1, "tid": threads[thread],
+                    "ts": round((start - self.origin) * 1e6, 3), "dur": round(duration * 1e6, 3)}
+                   for name, category, start, duration, thread in self.spans]
+        with open(self.trace_path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+
+def profiled_action(name: str):
+    """Decorator for UI methods: time each call as an action span of the frame profiler."""
+    def decorate(method):
+        @wraps(method)
+        def timed(self, *args, **kwargs):
+            with self.frame_profiler.span(name, "action"):
+                return method(self, *args, **kwargs)
+        return timed
+    return decorate
+
+
+# --- FONT REGISTRY ---
+FONT_CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "python_paint", "fonts.json")
+
+
+class FontRegistry:
+    """
+    Process-wide cache of Font objects, one per (name, size).
+    System font names are resolved to file paths once and the paths are
+    persisted, so later runs skip the system font scan entirely. Names with
+    no installed font are only remembered for this process: a font
+    installed later is found by the next run.
+    """
+    def __init__(self, cache_path: str = FONT_CACHE_PATH):
+        self.cache_path = cache_path
+        self._fonts: dict = {}
+        self._paths: Optional[dict] = None
+        self._missing: set = set()
+
+    def get(self, name: Optional[str], size: int) -> pygame.font.Font:
+        """Return the shared Font for name and size; None is pygame's default font."""
+        key = (name, size)
+        font = self._fonts.get(key)
+        if font is None:
+            if not pygame.font.get_init():
+                pygame.font.init()
+            font = self._fonts[key] = pygame.font.Font(self.resolve(name), size)
+        return font
+
+    def resolve(self, name: Optional[str]) -> Optional[str]:
         """
-        Optimized scanline flood fill algorithm.
-        Fills a connected region of the same color with a new color.
+        Return the font file for a system font name, or None for the default font.
+        Unknown names fall back to the default font, like pygame.font.SysFont.
         """
-        # Change cursor to indicate processing
-        pygame.mouse.set_cursor(2)
-        arr = pygame.surfarray.pixels2d(surface)
-        x, y = position
-        w, h = arr.shape
-        orig_color = arr[x, y]
-        fill_color_mapped = surface.map_rgb(fill_color)
+        if name is None:
+            return None
 
-        # Don't fill if already the target color
-        if orig_color == fill_color_mapped:
-            pygame.mouse.set_cursor(pygame.Cursor(11))
-            return
+        paths = self._load_paths()
+        if name in paths and os.path.isfile(paths[name]):
+            return paths[name]
+        if name in self._missing:
+            return None
 
-        stack = [(x, y)]
-        
-        while stack:
-            nx, ny = stack.pop()
-            if nx < 0 or nx >= w or ny < 0 or ny >= h or arr[nx, ny] != orig_color:
-                continue
-
-            # Find west and east boundaries of the scanline
-            west = nx
-            east = nx
-            while west > 0 and arr[west - 1, ny] == orig_color:
-                west -= 1
-            while east < w - 1 and arr[east + 1, ny] == orig_color:
-                east += 1
-
-            # Fill the entire scanline at once for efficiency
-            arr[west:east + 1, ny] = fill_color_mapped
-
-            # Check north/south neighbors only at segment boundaries to avoid duplicates
-            if ny > 0:
-                in_segment = False
-                for i in range(west, east + 1):
-                    is_target = arr[i, ny - 1] == orig_color
-                    if is_target and not in_segment:
-                        stack.append((i, ny - 1))
-                        in_segment = True
-                    elif not is_target:
-                        in_segment = False
-                        
-            if ny < h - 1:
-                in_segment = False
-                for i in range(west, east + 1):
-                    is_target = arr[i, ny + 1] == orig_color
-                    if is_target and not in_segment:
-                        stack.append((i, ny + 1))
-                        in_segment = True
-                    elif not is_target:
-                        in_segment = False
-
-        # Apply changes back to surface
-        pygame.surfarray.blit_array(surface, arr)
-        pygame.mouse.set_cursor(pygame.Cursor(11))
-
-    def rainbowColor(self):
-        """
-        Returns a rainbow color based on the current color_value.
-        Cycles through red -> yellow -> green -> cyan -> blue -> magenta.
-        """
-        step = (self.color_value // 256) % 6
-        pos = self.color_value % 256
-        if step == 0:
-            return (255, pos, 0)
-        if step == 1:
-            return (255-pos, 255, 0)
-        if step == 2:
-            return (0, 255, pos)
-        if step == 3:
-            return (0, 255-pos, 255)
-        if step == 4:
-            return (pos, 0, 255)
-        if step == 5:
-            return (255, 0, 255-pos)
-
-    def round_line(self, screen, start):
-        """
-        Draws a smooth interpolated line between the last position and current position.
-        Prevents gaps when mouse moves quickly.
-        """
-        x_axis = self.last_position[0]-start[0]
-        y_axis = self.last_position[1]-start[1]
-        dist = max(abs(x_axis), abs(y_axis))
-        for i in range(dist):
-            x = int(start[0]+float(i)/dist*x_axis)
-            y = int(start[1]+float(i)/dist*y_axis)
-            pygame.draw.circle(screen, self.color, (x, y), self.size)
-
-    def draw(self, screen, mouse_position):
-        """
-        Main drawing method. Handles fill mode, rainbow mode, and normal drawing.
-        """
-        if(self.fill):
-            # Fill mode: flood fill the clicked area
-            if screen.get_at(mouse_position)[:3] != self.color:
-                self.floodFill(screen, mouse_position, self.color)
-
-        elif(self.rainbow):
-            # Rainbow mode: cycle through colors automatically
-            self.color_value = (self.color_value + 8) % (256 * 6)
-            self.color = self.rainbowColor()
-            
-        else:
-            # Normal mode: draw a circle at mouse position
-            pygame.draw.circle(screen, self.color, mouse_position, self.size)
+        # Scans the installed fonts the first time it is called
+        path = pygame.font.match_font(name)
+        if path is None:
+            self._missing.add(name)
+            return None
+        paths[name] = path
+        self._save_paths()
+        return path
+
+    def _load_paths(self) -> dict:
+        """Read the persisted name-to-path cache on first use (older caches also kept misses, as null)."""
+        if self._paths is None:
+            try:
+                with open(self.cache_path, "r", encoding="utf-8") as f:
+                    self._paths = {name: path for name, path in json.load(f).items() if isinstance(path, str)}
+            except (OSError, ValueError, AttributeError):
+                self._paths = {}
+        return self._paths
+
+    def _save_paths(self) -> None:
+        """Persist the name-to-path cache; failing to write it only costs a rescan next run."""
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(self.cache_path, "w", encoding="utf-8") as f:
+                json.dump(self._paths, f)
+        except OSError:
+            pass
 
-        # Draw smooth line if we have a previous position
-        if(self.enable_last_position):
-            self.round_line(screen, mouse_position)
 
-        self.last_position = mouse_position
+fonts = FontRegistry()
+
+
+def get_font(name: Optional[str], size: int) -> pygame.font.Font:
+    """Return the shared Font for name and size from the process-wide registry."""
+    return fonts.get(name, size)
 
 
 # --- BUTTON CLASS ---
+@lru_cache(maxsize=None)
+def hover_gradient(width: int, height: int) -> pygame.Surface:
+    """
+    Returns the translucent top-to-bottom shade drawn over hovered buttons.
+    Built once per button size and shared by every button of that size.
+    """
+    gradient = pygame.Surface((width, height), pygame.SRCALPHA)
+    for y in range(height):
+        alpha = int(128 * (y / height))
+        pygame.draw.line(gradient, (0, 0, 0, alpha), (0, y), (width, y))
+    return gradient
+
+
 @dataclass
 class RectButton:
     """
@@ -168,7 +316,7 @@ class RectButton:
     color: Tuple[int, int, int]
     outline_color: Tuple[int, int, int] = (0,0,0)
     text: Optional[str] = None
-    font: pygame.font.Font = field(default_factory=lambda: pygame.font.SysFont(None, 24))
+    font: pygame.font.Font = field(default_factory=lambda: get_font(None, 24))
     on_click: Optional[Callable[[], None]] = None
     on_hover_gradient_enabled: bool = field(default=True)
     enabled: bool = field(default=True)
@@ -176,6 +324,9 @@ class RectButton:
 
     _is_hovered: bool = field(default=False, init=False)
     _is_selected: bool = field(default=False, init=False)
+    _drawn_key: Optional[tuple] = field(default=None, init=False)
+    _render_cache: dict = field(default_factory=dict, init=False)
+    _render_signature: Optional[tuple] = field(default=None, init=False)
 
     default_outline: Tuple[int,int,int] = (0,0,0)
     selected_outline: Tuple[int,int,int] = (150,150,150)
@@ -202,23 +353,55 @@ class RectButton:
         """Returns the appropriate outline color based on selection state."""
         return self.selected_outline if self.is_selected else self.default_outline
 
-    def draw(self, surface: pygame.Surface) -> None:
-        """Draws the button with its text and hover gradient if applicable."""
-        pygame.draw.rect(surface, self.color, self.rect)
-        pygame.draw.rect(surface, self.get_draw_outline(), self.rect, width=2)
+    @property
+    def render_key(self) -> tuple:
+        """Everything that affects how the button looks; it needs a redraw when this changes."""
+        show_gradient = self._is_hovered and self.on_hover_gradient_enabled and self.enabled
+        return (tuple(self.rect), self.color, self.get_draw_outline(), self.text, self.current_text_color, show_gradient)
+
+    @property
+    def render_signature(self) -> tuple:
+        """Properties shared by every visual state; the render cache is dropped when they change."""
+        return (self.width, self.height, self.color, self.default_outline, self.selected_outline, self.text, id(self.font))
+
+    @property
+    def render_state(self) -> tuple:
+        """The visual state (selected, hovered, disabled) the button is currently in."""
+        return (self.is_selected, self._is_hovered and self.on_hover_gradient_enabled and self.enabled, self.enabled)
+
+    def render(self) -> pygame.Surface:
+        """Renders the button with its text and hover gradient if applicable."""
+        image = pygame.Surface((self.width, self.height))
+        local_rect = image.get_rect()
+        pygame.draw.rect(image, self.color, local_rect)
+        pygame.draw.rect(image, self.get_draw_outline(), local_rect, width=2)
 
         if self.text:
             txt_surf = self.font.render(self.text, True, self.current_text_color)
-            txt_rect = txt_surf.get_rect(center=self.rect.center)
-            surface.blit(txt_surf, txt_rect)
+            txt_rect = txt_surf.get_rect(center=local_rect.center)
+            image.blit(txt_surf, txt_rect)
 
         # Draw hover gradient effect
         if self._is_hovered and self.on_hover_gradient_enabled and self.enabled:
-            gradient = pygame.Surface((self.width, self.height), pygame.SRCALPHA)
-            for y in range(self.height):
-                alpha = int(128 * (y / self.height))
-                pygame.draw.line(gradient, (0, 0, 0, alpha), (0, y), (self.width, y))
-            surface.blit(gradient, (self.x, self.y))
+            image.blit(hover_gradient(self.width, self.height), (0, 0))
+        return image
+
+    def cached_render(self) -> pygame.Surface:
+        """Returns the pre-rendered image for the current visual state, rendering it on first use."""
+        signature = self.render_signature
+        if signature != self._render_signature:
+            self._render_cache = {}
+            self._render_signature = signature
+
+        state = self.render_state
+        image = self._render_cache.get(state)
+        if image is None:
+            image = self._render_cache[state] = self.render()
+        return image
+
+    def draw(self, surface: pygame.Surface) -> None:
+        """Draws the button by blitting its pre-rendered image."""
+        surface.blit(self.cached_render(), (self.x, self.y))
 
     def update(self) -> None:
         """Updates hover state and cursor based on mouse position."""
@@ -270,18 +453,27 @@ class UndoRedoButton(RectButton):
     Special button that manages a history stack for undo/redo operations.
     Automatically enables/disables based on whether history is available.
     """
-    _history_stack: List[pygame.Surface] = field(default_factory=list, init=False)
+    memory_budget: int = field(default=HISTORY_MEMORY_BUDGET)
+    _history_stack: HistoryStore = field(default=None, init=False)
+
+    def __post_init__(self):
+        self._history_stack = HistoryStore(self.memory_budget)
 
     @property
     def history_stack(self):
         return self._history_stack
 
-    def push(self, surface: pygame.Surface):
+    @property
+    def memory_usage(self) -> Tuple[int, int]:
+        """Returns the (RAM, disk) bytes used by this history stack."""
+        return self._history_stack.ram_bytes, self._history_stack.disk_bytes
+
+    def push(self, entry: HistoryEntry):
         """Add a new state to the stack and enable button."""
-        self._history_stack.append(surface)
+        self._history_stack.push(entry)
         self.enabled = True
 
-    def pop(self) -> pygame.Surface | None:
+    def pop(self) -> HistoryEntry | None:
         """Remove the most recent state and disable button if empty."""
         if self._history_stack:
             removed = self._history_stack.pop()
@@ -291,7 +483,7 @@ class UndoRedoButton(RectButton):
         
     def empty_history(self):
         """Clear all history and disable the button."""
-        self._history_stack = []
+        self._history_stack.clear()
         self.enabled = False
 
 @dataclass
@@ -302,30 +494,60 @@ class PickerButton(RectButton):
     """
     path: str = "picker/color_grid.png"
     _image: pygame.surface.Surface = field(default=None, init=False)
+    _colors: np.ndarray = field(default=None, init=False)
+
+    # Decoded grid images shared across picker openings: path -> (surface, RGB array)
+    _grid_cache: ClassVar[dict] = {}
 
     @property
     def image(self) -> pygame.surface.Surface:
-        """Return the loaded color picker image."""
+        """Return the loaded color picker image, loading it on first use."""
+        if self._image is None:
+            self.load()
         return self._image
 
     @image.setter
     def image(self, value: pygame.surface.Surface):
         """Set the current color picker image."""
         self._image = value
+        self._colors = pygame.surfarray.array3d(value)
+
+    @property
+    def colors(self) -> np.ndarray:
+        """RGB values of the picker image as an array indexed [x, y]."""
+        if self._colors is None:
+            self.load()
+        return self._colors
 
     def check(self) -> bool:
         """Check if the image path exists and is accessible."""
         return os.path.isfile(self.path)
+
+    def load(self) -> None:
+        """
+        Load the picker image and its color array.
+        The file is decoded once per process and reused by every picker opening.
+        """
+        cached = self._grid_cache.get(self.path)
+        if cached is None:
+            if not self.check():
+                raise FileNotFoundError(f"Color picker image not found at: {self.path}")
+            image = pygame.image.load(self.path).convert_alpha()
+            cached = self._grid_cache[self.path] = (image, pygame.surfarray.array3d(image))
+        self._image, self._colors = cached
+
+    def color_at(self, position: Tuple[int, int]) -> Optional[Tuple[int, int, int]]:
+        """Returns the RGB color at a position local to the picker, or None outside the image."""
+        x, y = position
+        colors = self.colors
+        if 0 <= x < colors.shape[0] and 0 <= y < colors.shape[1]:
+            r, g, b = colors[x, y]
+            return int(r), int(g), int(b)
+        return None
     
     def draw(self, surface: pygame.Surface) -> None:
         """Draws the color picker grid image at the specified position."""
-        if not self.check():
-            raise FileNotFoundError(f"Color picker image not found at: {self.path}")
-
-        self.screenshot = surface.subsurface(self.rect).copy()
-        color_picker_grid_image = pygame.image.load(self.path).convert_alpha()
-        self.image = color_picker_grid_image
-        surface.blit(self.image, (200, 0))
+        surface.blit(self.image, (self.x, self.y))
 
     def update(self) -> None:
         """Updates hover state with crosshair cursor for precise color selection."""
@@ -350,6 +572,165 @@ class PickerButton(RectButton):
                 return True
         return False
 
+    def pick(self, position: Tuple[int, int]) -> Optional[Tuple[int, int, int]]:
+        """Select the color at a position local to the picker. Returns it, or None outside the image."""
+        return self.color_at(position)
+
+    def sync(self, color: Tuple[int, int, int]) -> None:
+        """Follow a color chosen elsewhere (sliders, palette slots). The grid image has no state to update."""
+
+
+# --- HSV PICKER ---
+HUE_STEPS = 360
+HUE_PLANE_CACHE_SIZE = 32
+
+
+def hsv_to_rgb_array(h: np.ndarray, s: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """
+    Vectorized HSV to RGB conversion for arrays of hue, saturation and value in [0, 1].
+    Returns uint8 RGB values with a trailing channel axis.
+    """
+    h6 = (h % 1.0) * 6.0
+    sector = np.floor(h6).astype(np.int32) % 6
+    f = h6 - np.floor(h6)
+    p = v * (1 - s)
+    q = v * (1 - f * s)
+    t = v * (1 - (1 - f) * s)
+    r = np.choose(sector, [v, q, p, p, t, v])
+    g = np.choose(sector, [t, v, v, q, p, p])
+    b = np.choose(sector, [p, p, t, v, v, q])
+    return np.rint(np.stack([r, g, b], axis=-1) * 255).astype(np.uint8)
+
+
+def pure_hue(hue_step: int) -> np.ndarray:
+    """Returns the fully saturated RGB color of a quantized hue as float32."""
+    one = np.float32(1)
+    return hsv_to_rgb_array(np.float32(hue_step / HUE_STEPS), one, one).astype(np.float32)
+
+
+def blend_sv(hue_rgb: np.ndarray, s: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """
+    Blend a pure hue towards white (saturation) and black (value).
+    Equivalent to HSV to RGB for a fixed hue, with broadcasting.
+    """
+    return np.rint(v * (255 - s * (255 - hue_rgb))).astype(np.uint8)
+
+
+def hsv_color(hue_step: int, saturation: float, value: float) -> Tuple[int, int, int]:
+    """Returns the RGB color of a quantized hue with the given saturation and value."""
+    r, g, b = blend_sv(pure_hue(hue_step), np.float32(saturation), np.float32(value))
+    return int(r), int(g), int(b)
+
+
+@lru_cache(maxsize=HUE_PLANE_CACHE_SIZE)
+def hue_plane(hue_step: int, width: int, height: int) -> pygame.Surface:
+    """
+    Returns the saturation/value square of one hue as a surface.
+    Saturation grows left to right and value grows bottom to top.
+    The most recently used planes are kept, so dragging back and forth
+    over the hue strip does not rebuild them.
+    """
+    s = np.linspace(0, 1, width, dtype=np.float32)[:, None, None]
+    v = np.linspace(1, 0, height, dtype=np.float32)[None, :, None]
+    return pygame.surfarray.make_surface(blend_sv(pure_hue(hue_step), s, v))
+
+
+@lru_cache(maxsize=None)
+def hue_strip(width: int, height: int) -> pygame.Surface:
+    """Returns the vertical strip of fully saturated hues, red at the top."""
+    # The quantized hue of each row (as pure_hue rounds it), converted in one call
+    hues = (np.arange(height) * HUE_STEPS // height / HUE_STEPS).astype(np.float32)
+    one = np.float32(1)
+    column = hsv_to_rgb_array(hues, one, one)
+    return pygame.surfarray.make_surface(np.ascontiguousarray(np.broadcast_to(column, (width, height, 3))))
+
+
+@dataclass
+class HSVPickerButton(PickerButton):
+    """
+    Procedurally generated color picker: a saturation/value square for the
+    current hue, with a hue strip on its right. Works at any size and needs
+    no image asset.
+    """
+    strip_width: int = 40
+    strip_gap: int = 10
+    hue_step: int = 0
+    saturation: float = 1.0
+    value: float = 1.0
+
+    @property
+    def square_width(self) -> int:
+        """Width of the saturation/value square."""
+        return self.width - self.strip_width - self.strip_gap
+
+    @property
+    def current_color(self) -> Tuple[int, int, int]:
+        """The RGB color of the current hue, saturation and value."""
+        return hsv_color(self.hue_step, self.saturation, self.value)
+
+    def load(self) -> None:
+        """The picker is generated, there is no image to load."""
+
+    def color_at(self, position: Tuple[int, int]) -> Optional[Tuple[int, int, int]]:
+        """Returns the RGB color shown at a position local to the picker, or None outside it."""
+        x, y = position
+        if not (0 <= y < self.height):
+            return None
+        if 0 <= x < self.square_width:
+            return hsv_color(self.hue_step, *self._square_sv(x, y))
+        if self.square_width + self.strip_gap <= x < self.width:
+            return hsv_color(self._strip_hue(y), 1.0, 1.0)
+        return None
+
+    def pick(self, position: Tuple[int, int]) -> Optional[Tuple[int, int, int]]:
+        """
+        Pick from the square (sets saturation and value) or the strip (sets the hue).
+        Returns the resulting color, or None outside both.
+        """
+        x, y = position
+        y = max(0, min(self.height - 1, y))
+        if 0 <= x < self.square_width:
+            self.saturation, self.value = self._square_sv(x, y)
+        elif self.square_width + self.strip_gap <= x < self.width:
+            self.hue_step = self._strip_hue(y)
+        else:
+            return None
+        return self.current_color
+
+    def sync(self, color: Tuple[int, int, int]) -> None:
+        """Move the markers to a color chosen elsewhere, keeping the hue for grays."""
+        if color == self.current_color:
+            return
+        h, s, v = colorsys.rgb_to_hsv(*(channel / 255 for channel in color))
+        if s > 0 and v > 0:
+            self.hue_step = int(round(h * HUE_STEPS)) % HUE_STEPS
+        self.saturation, self.value = s, v
+
+    def draw(self, surface: pygame.Surface) -> None:
+        """Draws the cached hue plane, the hue strip and the selection markers."""
+        pygame.draw.rect(surface, (50, 50, 50), self.rect)
+        surface.blit(hue_plane(self.hue_step, self.square_width, self.height), (self.x, self.y))
+        strip_x = self.x + self.square_width + self.strip_gap
+        surface.blit(hue_strip(self.strip_width, self.height), (strip_x, self.y))
+
+        # Markers for the current saturation/value and hue
+        marker_x = self.x + int(round(self.saturation * (self.square_width - 1)))
+        marker_y = self.y + int(round((1 - self.value) * (self.height - 1)))
+        outline = (0, 0, 0) if self.value > 0.5 else (255, 255, 255)
+        pygame.draw.circle(surface, outline, (marker_x, marker_y), 7, width=2)
+        hue_y = self.y + int(self.hue_step * self.height / HUE_STEPS)
+        pygame.draw.rect(surface, (255, 255, 255), (strip_x - 2, hue_y - 2, self.strip_width + 4, 5), width=1)
+
+    def _square_sv(self, x: int, y: int) -> Tuple[float, float]:
+        """Saturation and value under a position in the square (same sampling as the plane, in float32)."""
+        s = np.float32(x / (self.square_width - 1))
+        v = np.float32(1 - y / (self.height - 1))
+        return float(s), float(v)
+
+    def _strip_hue(self, y: int) -> int:
+        """Quantized hue under a height in the strip."""
+        return min(HUE_STEPS - 1, y * HUE_STEPS // self.height)
+
 
 @dataclass
 class CircleButton:
@@ -369,6 +750,8 @@ class CircleButton:
     
     _is_hovered: bool = field(default=False, init=False)
     _is_selected: bool = field(default=False, init=False)
+    _drawn_key: Optional[tuple] = field(default=None, init=False)
+    _render_cache: dict = field(default_factory=dict, init=False)
 
     default_color: Tuple[int,int,int] = (255,255,255)
     default_outline: Tuple[int,int,int] = (0,0,0)
@@ -400,11 +783,26 @@ class CircleButton:
         else:
             return self.default_color, self.default_outline
 
-    def draw(self, surface):
-        """Draws the circular button with appropriate colors."""
+    @property
+    def render_key(self) -> tuple:
+        """Everything that affects how the button looks; it needs a redraw when this changes."""
+        return (self.x, self.y, self.radius, self.get_draw_colors())
+
+    def render(self) -> pygame.Surface:
+        """Renders the circular button with appropriate colors on a transparent surface."""
         fill, outline = self.get_draw_colors()
-        pygame.draw.circle(surface, fill, (self.x, self.y), self.radius)
-        pygame.draw.circle(surface, outline, (self.x, self.y), self.radius, width=2)
+        image = pygame.Surface((self.radius * 2, self.radius * 2), pygame.SRCALPHA)
+        pygame.draw.circle(image, fill, (self.radius, self.radius), self.radius)
+        pygame.draw.circle(image, outline, (self.radius, self.radius), self.radius, width=2)
+        return image
+
+    def draw(self, surface):
+        """Draws the circular button by blitting its pre-rendered image."""
+        key = (self.radius, self.get_draw_colors())
+        image = self._render_cache.get(key)
+        if image is None:
+            image = self._render_cache[key] = self.render()
+        surface.blit(image, (self.x - self.radius, self.y - self.radius))
 
     def update(self) -> None:
         """Updates hover state and cursor using circular collision."""
@@ -463,6 +861,7 @@ class ColorSlider(RectButton):
     color_picker: 'ColorPicker' = None  # Reference to parent ColorPicker
     _slider_length: int = field(default=0, init=False)
     _is_dragging: bool = field(default=False, init=False)
+    _label_cache: dict = field(default_factory=dict, init=False)
 
     @property
     def current_text_color(self) -> Tuple[int,int,int]:
@@ -474,6 +873,37 @@ class ColorSlider(RectButton):
         """Return the current slider length based on color value."""
         return self._slider_length
 
+    @property
+    def render_key(self) -> tuple:
+        """Everything that affects how the slider looks, including its channel value."""
+        value = self.color_picker.hover_color if self.color_picker else None
+        return (tuple(self.rect), self.color, self.get_draw_outline(), self.slider_color, self.channel, value)
+
+    @property
+    def render_signature(self) -> tuple:
+        """Properties of the slider track; the value label is cached separately."""
+        return (self.width, self.height, self.color, self.default_outline, self.selected_outline)
+
+    @property
+    def render_state(self) -> tuple:
+        """Sliders have no hover or disabled look, only the selection outline."""
+        return (self.is_selected,)
+
+    def render(self) -> pygame.Surface:
+        """Renders the empty slider track with its outline."""
+        image = pygame.Surface((self.width, self.height))
+        pygame.draw.rect(image, self.color, image.get_rect())
+        pygame.draw.rect(image, self.get_draw_outline(), image.get_rect(), width=2)
+        return image
+
+    def label(self, text: str) -> pygame.Surface:
+        """Returns the rendered value label, rendering each distinct text once."""
+        key = (text, id(self.font))
+        txt_surf = self._label_cache.get(key)
+        if txt_surf is None:
+            txt_surf = self._label_cache[key] = self.font.render(text, True, self.current_text_color)
+        return txt_surf
+
     def update_from_mouse(self, mouse_x: int):
         """Update the color value based on mouse x position."""
         if not self.color_picker:
@@ -521,12 +951,11 @@ class ColorSlider(RectButton):
         # Display the actual RGB value (0-255), not the pixel width
         self.text = f"{self.channel.upper()}: {value}"
 
-        pygame.draw.rect(surface, self.color, self.rect)
-        pygame.draw.rect(surface, self.get_draw_outline(), self.rect, width=2)
+        surface.blit(self.cached_render(), (self.x, self.y))
         pygame.draw.rect(surface, self.slider_color, slider_rect)
 
         if self.text:
-            txt_surf = self.font.render(self.text, True, self.current_text_color)
+            txt_surf = self.label(self.text)
             # Position text to the right of the slider
             center = (self.rect.right + 40, self.rect.centery)
             txt_rect = txt_surf.get_rect(center=center)
@@ -568,6 +997,21 @@ class ButtonManager:
         """Draw all buttons to the surface."""
         for btn in self.buttons:
             btn.draw(surface)
+            btn._drawn_key = btn.render_key
+
+    def draw_changed(self, surface: pygame.Surface) -> List[pygame.Rect]:
+        """
+        Draw only the buttons whose appearance changed since they were last drawn.
+        Returns the areas that were redrawn.
+        """
+        rects = []
+        for btn in self.buttons:
+            key = btn.render_key
+            if key != btn._drawn_key:
+                btn.draw(surface)
+                btn._drawn_key = key
+                rects.append(btn.rect)
+        return rects
 
     def handle_event(self, event: pygame.event.Event) -> None:
         """Process events for all buttons (keyboard shortcuts and clicks)."""
@@ -616,6 +1060,7 @@ class ColorPicker:
     new_colors: list[list[tuple[int, int, int]]]  # Temporary colors being edited
     default_colors: list[list[tuple[int, int, int]]]  # Default palette for reset
     filename: str = "picker/color_grid.png"
+    mode: str = "grid"  # 'grid' (image asset) or 'hsv' (generated)
     on_close: callable = None
     on_cancel: callable = None 
     coord: int = 0  # Currently selected palette slot index
@@ -629,7 +1074,6 @@ class ColorPicker:
     _is_dragging: bool = field(default=False, init=False)
     _temp_hover_color: Tuple[int, int, int] = field(default=(255,255,255), init=False)
 
-    _screenshot: pygame.Surface = field(default=None, init=False)
     _hover_color: Tuple[int, int, int] = field(default=(255,255,255), init=False)
 
     @property
@@ -641,15 +1085,6 @@ class ColorPicker:
     def hover_color(self, value: Tuple[int, int, int]):
         self._hover_color = value
 
-    @property
-    def screenshot(self) -> pygame.Surface:
-        """Saved screenshot of the canvas before opening the picker."""
-        return self._screenshot
-    
-    @screenshot.setter
-    def screenshot(self, value: pygame.Surface):
-        self._screenshot = value 
-
     @property
     def path(self) -> str:
         """Return the absolute path to the color picker grid image."""
@@ -741,12 +1176,7 @@ class ColorPicker:
         Includes the picker grid, control buttons, and palette slots.
         """
         # Picker grid button (no on_click, handled in main loop)
-        self.color_picker_button_manager.add(PickerButton(
-            x=200, y=0, width=720, height=720, 
-            color=(255,255,255), 
-            path=self.path, 
-            on_click=None
-        ))
+        self.color_picker_button_manager.add(self.make_picker_button())
         
         # Save button
         self.color_picker_button_manager.add(RectButton(
@@ -781,6 +1211,17 @@ class ColorPicker:
             shortcut=(pygame.K_d, True, False)  # Ctrl+D
         ))
 
+        # Switch between the image grid and the generated HSV picker
+        self.color_picker_button_manager.add(RectButton(
+            x=950, y=560, width=300, height=50, 
+            color=(200,200,200), text=self.mode_button_text, 
+            font=self.font, 
+            on_click=self.toggle_mode, 
+            default_outline=(0,0,0), 
+            selected_outline=(0,0,0),
+            shortcut=(pygame.K_h, True, False)  # Ctrl+H
+        ))
+
         # Create palette slot buttons (HORIZONTAL layout: rows then columns)
         for y in range(2):  # Rows (top, bottom)
             for x in range(6):  # Columns (left to right)
@@ -817,6 +1258,34 @@ class ColorPicker:
             )
             self.color_picker_slider_manager.add(slider)
 
+    @property
+    def mode_button_text(self) -> str:
+        """Label of the mode switch button: the mode it switches to."""
+        return "GRID PICKER" if self.mode == "hsv" else "HSV PICKER"
+
+    def make_picker_button(self) -> PickerButton:
+        """
+        Create the picker area for the current mode.
+        Falls back to the generated HSV picker when the grid image is missing.
+        """
+        if self.mode == "grid" and not os.path.isfile(self.path):
+            self.mode = "hsv"
+
+        if self.mode == "hsv":
+            picker_button = HSVPickerButton(x=200, y=0, width=720, height=720, color=(255,255,255), on_click=None)
+            picker_button.sync(self.hover_color)
+            return picker_button
+        return PickerButton(x=200, y=0, width=720, height=720, color=(255,255,255), path=self.path, on_click=None)
+
+    def toggle_mode(self):
+        """Switch between the image grid picker and the generated HSV picker."""
+        self.mode = "hsv" if self.mode == "grid" else "grid"
+        buttons = self.color_picker_button_manager.buttons
+        buttons[0] = self.make_picker_button()
+        for button in buttons:
+            if button.on_click == self.toggle_mode:
+                button.text = self.mode_button_text
+
     def make_picker_ui(self, screen: pygame.Surface):
         """
         Draw the picker interface background and color preview.
@@ -839,37 +1308,359 @@ class ColorPicker:
         
     def destroy(self, screen: pygame.Surface) -> None:
         """
-        Close the color picker and restore the previous screen state.
-        Restores the canvas from the saved screenshot.
+        Close the color picker.
+        The drawing lives on its own canvas, so there is nothing to restore:
+        the UI recomposites the window on the next frame.
         """
-        if self.screenshot is None:
-            return
-        pygame.surfarray.blit_array(screen.subsurface(pygame.Rect(200, 0, 1080, 720)), pygame.surfarray.pixels2d(self.screenshot))
-        self.screenshot = None
+        self._is_dragging = False
 
     def update(self, screen: pygame.Surface):
         """Update the picker UI (refresh the preview and background)."""
+        self.color_picker_button_manager.buttons[0].sync(self.hover_color)
         self.make_picker_ui(screen)
 
+# --- SESSION RECORDING ---
+SESSION_VERSION = 1
+SESSION_DIALOGS = ("ask_yes_no", "select_save_file", "select_image")
+
+
+def _event_to_json(event: pygame.event.Event) -> list:
+    """[type, attributes] of an event; attributes JSON cannot hold (like window objects) are dropped."""
+    attributes = {}
+    for name, value in event.dict.items():
+        if isinstance(value, tuple):
+            value = list(value)
+        if value is None or isinstance(value, (bool, int, float, str, list)):
+            attributes[name] = value
+    return [event.type, attributes]
+
+
+def _event_from_json(data: list) -> pygame.event.Event:
+    """Rebuild an event written by _event_to_json."""
+    kind, attributes = data
+    return pygame.event.Event(kind, {name: tuple(value) if isinstance(value, list) else value
+                                     for name, value in attributes.items()})
+
+
+class SessionRecorder:
+    """
+    Records the input of a session, frame by frame, to a JSON lines file:
+    the events, the mouse and modifier key state when they changed, and the
+    answers of the dialogs. SessionReplayer plays it back.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.start = 0.0
+        self.state = None
+        self.frame = None
+        self.dialogs = []
+
+    def begin(self, ui: 'UI') -> None:
+        """Start recording; the dialogs of ui record their answers."""
+        self.file = open(self.path, "w")
+        json.dump({"version": SESSION_VERSION, "pygame": pygame.version.ver,
+                   "screen": [ui.screen_width, ui.screen_height], "canvas": [ui.canvas.width, ui.canvas.height]}, self.file)
+        self.file.write("\n")
+        for name in SESSION_DIALOGS:
+            setattr(ui, name, self._recording(name, getattr(ui, name)))
+        self.start = time.perf_counter()
+
+    def _recording(self, name: str, dialog: Callable):
+        def ask(*args, **kwargs):
+            answer = dialog(*args, **kwargs)
+            self.dialogs.append([name, answer])
+            return answer
+        return ask
+
+    def events(self, events: List[pygame.event.Event]) -> List[pygame.event.Event]:
+        """Record the events of this frame, polled from pygame."""
+        frame = {"t": round(time.perf_counter() - self.start, 6)}
+        state = (pygame.mouse.get_pos(), pygame.mouse.get_pressed(), pygame.key.get_mods())
+        if state != self.state:
+            frame["m"], frame["b"], frame["k"] = state
+            self.state = state
+        if events:
+            frame["e"] = [_event_to_json(event) for event in events]
+        self.frame = frame
+        return events
+
+    def end_frame(self, ui: 'UI') -> None:
+        """Write the frame, with the answers of the dialogs it opened."""
+        frame = self.frame
+        if self.dialogs:
+            frame["d"], self.dialogs = self.dialogs, []
+        json.dump(frame, self.file, separators=(",", ":"))
+        self.file.write("\n")
+
+    @property
+    def finished(self) -> bool:
+        return False
+
+    def finish(self, ui: 'UI') -> None:
+        """Close the recording."""
+        self.file.close()
+
+
+class SessionReplayer:
+    """
+    Plays back a session recorded by SessionRecorder, as fast as possible or
+    with its original timing. The mouse, button and modifier key state comes
+    from the recording (pygame's own functions are patched until finish puts
+    them back) and dialogs give their recorded answers, so the replay needs
+    no user and runs under the SDL dummy driver. Files are opened again but never saved. Reports frame
+    time percentiles, CPU time and the hash of the final canvas.
+    """
+    def __init__(self, path: str, original_timing: bool = False):
+        with open(path) as file:
+            self.header = json.loads(file.readline())
+            if self.header.get("version") != SESSION_VERSION:
+                raise ValueError(f"unsupported session version: {self.header.get('version')!r}")
+            self.frames = [json.loads(line) for line in file if line.strip()]
+        self.original_timing = original_timing
+        self.index = 0
+        self.state = ((0, 0), (False, False, False), 0)
+        self.dialogs = []
+        self.frame_times = []
+        self.patched = []  # (module, name, original function) of the pygame functions replaced by begin
+
+    @property
+    def canvas_size(self) -> Tuple[int, int]:
+        """Size of the canvas the session was recorded on."""
+        return tuple(self.header["canvas"])
+
+    def begin(self, ui: 'UI') -> None:
+        """Route the input state and the dialogs of ui to the recording."""
+        replacements = (
+            (pygame.mouse, "get_pos", lambda: self.state[0]),
+            (pygame.mouse, "get_pressed", lambda num_buttons=3: self.state[1][:num_buttons]),
+            (pygame.key, "get_mods", lambda: self.state[2]),
+            (pygame.mouse, "set_cursor", lambda *args, **kwargs: None),  # The dummy driver has no cursors
+        )
+        for module, name, function in replacements:
+            self.patched.append((module, name, getattr(module, name)))
+            setattr(module, name, function)
+        for name in SESSION_DIALOGS:
+            setattr(ui, name, lambda *args, name=name, **kwargs: self.answer(name))
+        ui.fps = 0  # No frame limit: frames are paced by the recording, or not at all
+        ui.idle_pacing = False  # Nothing would wake the loop up, the input is not pygame's
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def answer(self, dialog: str):
+        """The recorded answer of a dialog opened in this frame (never a path to save to)."""
+        for i, (name, answer) in enumerate(self.dialogs):
+            if name == dialog:
+                del self.dialogs[i]
+                return None if name == "select_save_file" else answer
+        return None
+
+    def events(self, events: List[pygame.event.Event]) -> List[pygame.event.Event]:
+        """The recorded events of the next frame; pygame's own events are discarded."""
+        frame = self.frames[self.index]
+        if self.original_timing:
+            delay = self.start + frame["t"] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        self.frame_start = time.perf_counter()
+        if "m" in frame:
+            self.state = (tuple(frame["m"]), tuple(frame["b"]), frame["k"])
+        self.dialogs = list(frame.get("d", []))
+        return [_event_from_json(event) for event in frame.get("e", [])]
+
+    def end_frame(self, ui: 'UI') -> None:
+        """Record the time the frame took."""
+        self.frame_times.append(time.perf_counter() - self.frame_start)
+        self.index += 1
+
+    @property
+    def finished(self) -> bool:
+        return self.index >= len(self.frames)
+
+    def report(self, ui: 'UI') -> dict:
+        """Frame time percentiles (ms), total wall and CPU time (s) and the final canvas hash."""
+        times = np.array(self.frame_times or [0.0]) * 1000
+        return {
+            "frames": len(self.frame_times),
+            "p50_ms": float(np.percentile(times, 50)),
+            "p95_ms": float(np.percentile(times, 95)),
+            "p99_ms": float(np.percentile(times, 99)),
+            "max_ms": float(times.max()),
+            "wall_s": time.perf_counter() - self.start,
+            "cpu_s": time.process_time() - self.cpu_start,
+            "canvas_sha256": ui.canvas.digest(),
+        }
+
+    def finish(self, ui: 'UI') -> None:
+        """Put pygame's input functions back and print the report."""
+        while self.patched:
+            module, name, function = self.patched.pop()
+            setattr(module, name, function)
+        report = self.report(ui)
+        print(f"Replayed {report['frames']} frames in {report['wall_s']:.2f} s (CPU {report['cpu_s']:.2f} s)")
+        print(f"Frame time: p50 {report['p50_ms']:.2f} ms, p95 {report['p95_ms']:.2f} ms, "
+              f"p99 {report['p99_ms']:.2f} ms, max {report['max_ms']:.2f} ms")
+        print(f"Canvas SHA-256: {report['canvas_sha256']}")
+
+
+# --- BACKGROUND JOBS ---
+BACKGROUND_POLL_MS = 100  # How often an idle window checks on a running save or open
+STATUS_COLOR = (200, 200, 200)
+STATUS_ERROR_COLOR = (255, 120, 120)
+
+
+@dataclass
+class SaveJob:
+    """A save running on the save thread. The worker updates progress (0 to 1) as it writes."""
+    path: str
+    future: Optional[Future] = None
+    progress: float = 0.0
+    profiler: FrameProfiler = field(default_factory=FrameProfiler)  # Times the worker side (off by default)
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+    def set_progress(self, progress: float) -> None:
+        self.progress = progress
+
+    def run(self, write: Callable, *args) -> None:
+        """Runs on the save thread: write(*args), timed as a worker span."""
+        with self.profiler.span("save encode", "worker"):
+            write(*args)
+
+
+@dataclass
+class OpenJob:
+    """
+    An image being decoded on the open thread, to be drawn in an area of the
+    canvas, or opened as a new drawing when there is no area. The worker sets
+    the preview first when the format has a quick one.
+    """
+    path: str
+    size: Optional[Tuple[int, int]]  # Of the image file; the worker sets it when the header could not tell
+    area: Optional[pygame.Rect] = None  # To fit the image in; None opens it at full size as a new drawing
+    view_size: Tuple[int, int] = (0, 0)  # Smallest size of a new drawing
+    future: Optional[Future] = None
+    preview: Optional[pygame.Surface] = None
+    preview_shown: bool = False
+    profiler: FrameProfiler = field(default_factory=FrameProfiler)  # Times the worker side (off by default)
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+    @property
+    def full_size(self) -> bool:
+        return self.area is None
+
+    def drawing_size(self) -> Tuple[int, int]:
+        """The size of the new drawing a full size image opens as: the image, at least the visible area."""
+        width, height = self.size or self.view_size
+        return max(width, self.view_size[0]), max(height, self.view_size[1])
+
+    def image_rect(self) -> pygame.Rect:
+        """The canvas area the image covers (once its size is known)."""
+        if self.full_size:
+            return pygame.Rect((0, 0), self.size)
+        rect = pygame.Rect((0, 0), fitted_size(self.size, self.area.height))
+        rect.center = self.area.center
+        return rect
+
+    def decode(self):
+        """
+        Runs on the open thread: the preview, then the image decoded at the size
+        it is drawn at. A full size image is returned already placed on a new
+        canvas, as filling the tiles of a huge image takes a while too.
+        """
+        span = self.profiler.span
+        if self.size is not None:  # A preview is placed by the size of the image
+            with span("open preview", "worker"):
+                self.preview = load_preview(self.path)
+        with span("open decode", "worker"):
+            image = load_image(self.path, None if self.full_size else self.area.height)
+        if not self.full_size:
+            return image
+        self.size = image.get_size()
+        with span("open place", "worker"):
+            canvas = Canvas(*self.drawing_size())
+            canvas.place_image(image, (0, 0))
+            canvas.discard_history()
+        return canvas
+
+
+def _write_text(path: str, text: str) -> None:
+    with open(path, "w") as file:
+        file.write(text)
+
+
 # --- UI CLASS ---
+VIEW_PAN_STEP = 64  # Pixels scrolled per mouse wheel notch
+VIEW_OUTSIDE_COLOR = (120, 120, 120)  # Shown around a canvas smaller than the view
+ACTIVE_FPS = 144  # Frame rate while drawing or dragging
+IDLE_TIMEOUT_MS = 500  # Longest an idle frame waits for input
+
+
 class UI:
     """
     Main application class managing the paint program interface.
     Handles the canvas, toolbars, color palette, and all user interactions.
     """
-    def __init__(self, screen_size: Tuple[int,int], title: str = "UI"):
+    def __init__(self, screen_size: Tuple[int,int], title: str = "UI", history_budget: int = HISTORY_MEMORY_BUDGET,
+                 profiler: Optional[StartupProfiler] = None, canvas_size: Optional[Tuple[int, int]] = None,
+                 frame_profiler: Optional[FrameProfiler] = None):
+        self.profiler = profiler or StartupProfiler()
+        # Frame phase and action timings, for the HUD and --trace
+        self.frame_profiler = frame_profiler or FrameProfiler()
+        self.profiler.mark("imports")
+
+        # Only the subsystems the app uses (no audio, joystick, ...)
+        pygame.display.init()
+        pygame.font.init()
+        self.profiler.mark("pygame init")
+
         self.screen_width, self.screen_height = screen_size
         self.screen = pygame.display.set_mode(screen_size)
         pygame.display.set_caption(title)
         self.clock = pygame.time.Clock()
-        self.fps = 144
+        self.fps = ACTIVE_FPS
+        # Block on the event queue between frames unless something is being drawn or dragged
+        self.idle_pacing = True
+        self.pending_events: List[pygame.event.Event] = []
+        self.profiler.mark("window")
+
+        # Window layout: canvas_rect is the window area the canvas is shown in
+        self.canvas_rect = pygame.Rect(200, 0, self.screen_width-200, self.screen_height-50)
+        self.toolbar_rect = pygame.Rect(0, self.screen_height - 52, self.screen_width, 52)
+        self.indicator_rect = pygame.Rect(0, 600, 200, self.screen_height - 652)
+        # Free toolbar space between the picker button and the size buttons
+        self.status_rect = pygame.Rect(690, self.screen_height - 50, self.screen_width - 920, 50)
+
+        # The drawing itself, independent of the window (defaults to the visible area)
+        self.canvas = Canvas(*(canvas_size or self.canvas_rect.size))
+        # Canvas position shown at the top-left of canvas_rect
+        self.view_offset = (0, 0)
+        # The actions that made the drawing, for replay (see CommandLog)
+        self.command_log = CommandLog.for_canvas(self.canvas)
+
+        # Dirty-rectangle rendering state
+        self.dirty_rects: List[pygame.Rect] = []
+        self.full_redraw = True
+        self.indicator_state = None
+        # Status line (text, color) and the one on screen
+        self.status = ("", STATUS_COLOR)
+        self.status_shown = None
 
         # Global constants
-        self.font = pygame.font.SysFont("segoeuisymbol", 30)
+        self.font = get_font("segoeuisymbol", 30)
+        self.indicator_font = get_font(None, 22)
+        self.hud_font = get_font(None, HUD_LINE_HEIGHT)
+        self.profiler.mark("fonts")
         self.toolbar_button_manager = ButtonManager()
         self.palette_button_manager = ButtonManager()
         self.size_changer_button_manager = ButtonManager()
         self.brush = Brush()
+        self.brush.command_log = self.command_log
 
         self.selected = False
         # Main color palette: 2 columns x 6 rows
@@ -879,8 +1670,10 @@ class UI:
         self.default_colors = deepcopy(self.colors)
 
         self.drawing = False
+        self.stroke_points = []  # Mouse samples of the stroke not drawn yet (canvas coordinates)
         self.undo_button = None
         self.redo_button = None
+        self.history_budget = history_budget
 
         self.picking_color = False
         self.waiting_for_mouse_release = False 
@@ -892,8 +1685,20 @@ class UI:
             default_colors=self.default_colors
         )
         self.holding_picking = False
+        self.picker_opened_at = None  # perf_counter of the picker opening, until its first frame is shown
 
         self.icon_name = 'picker/icon_paint.png'
+        # Saves are encoded on a worker thread from a copy of the canvas, so drawing goes on meanwhile
+        self.save_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="save")
+        self.save_jobs: List[SaveJob] = []
+        # Images are decoded on another worker, showing a preview meanwhile
+        self.open_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="open")
+        self.open_job: Optional[OpenJob] = None
+        self.png_compression = PNG_COMPRESSION_LEVEL
+        self.png_filter = "none"
+        # Input recording or playback (see SessionRecorder and SessionReplayer)
+        self.session = None
+        self.profiler.mark("ui state")
 
     def save_project(self):
         """
@@ -905,50 +1710,73 @@ class UI:
         # Check if user cancelled the dialog
         if not save_path:
             return
-        
-        # Capture only the canvas area (exclude palette and toolbar)
-        screenshot = self.screen.subsurface(pygame.Rect(200, 0, self.screen_width-200, self.screen_height-50))
-        
-        try:
-            pygame.image.save(screenshot, save_path)
-            root = Tk()
-            root.withdraw()
-            messagebox.showinfo("Saved", f"Image saved to:\n{save_path}")
-            root.destroy()
-        except Exception as e:
-            root = Tk()
-            root.withdraw()
-            messagebox.showerror("Error", f"Failed to save image:\n{str(e)}")
-            root.destroy()
+        # The save span starts once the dialog is closed, so it times the app and not the user
+        with self.frame_profiler.span("save", "action"):
+            self.finish_open()
+
+            # Only the snapshot is taken here; encoding and writing happen on the save thread
+            job = SaveJob(save_path, profiler=self.frame_profiler)
+            if save_path.lower().endswith(COMMAND_LOG_EXTENSION):
+                job.future = self.save_pool.submit(job.run, _write_text, save_path, self.command_log.dumps(save_path))
+            else:
+                job.future = self.save_pool.submit(job.run, self.canvas.copy().save, save_path,
+                                                   self.png_compression, self.png_filter, job.set_progress)
+            self.save_jobs.append(job)
+            self.poll_saves()
+
+    def poll_saves(self) -> None:
+        """Show the progress of the running save in the status area, and the result of the finished ones."""
+        while self.save_jobs and self.save_jobs[0].future.done():
+            job = self.save_jobs.pop(0)
+            error = job.future.exception()
+            if error is None:
+                self.status = (f"Saved {job.name}", STATUS_COLOR)
+            else:
+                self.status = (f"Save failed: {error}", STATUS_ERROR_COLOR)
+        if self.save_jobs:
+            job = self.save_jobs[0]
+            self.status = (f"Saving {job.name}... {job.progress:.0%}", STATUS_COLOR)
 
-    def open_project(self):
+    def open_project(self, full_size: bool = False):
         """
         Open and display an image file on the canvas.
         Saves current state to undo history before loading.
+        With full_size, the image is opened at its own resolution as a new drawing.
         """
         path = self.select_image()
         
         # Check if user cancelled the dialog
         if not path:
             return
-        
-        try:
-            # Save current state before opening
-            undo_screen = self.screen.subsurface(pygame.Rect(200, 0, self.screen_width-200, self.screen_height-50)).copy()
-            self.undo_button.push(undo_screen)
-            self.display_image(path)
-        except Exception as e:
-            root = Tk()
-            root.withdraw()
-            messagebox.showerror("Error", f"Failed to open image:\n{str(e)}")
-            root.destroy()
+        # As for save, the span leaves out the dialog
+        with self.frame_profiler.span("open", "action"):
+            self.finish_open()
+
+            try:
+                if full_size:
+                    self.display_image_full_size(path)
+                else:
+                    self.display_image(path)
+            except Exception as e:
+                self.status = (f"Open failed: {e}", STATUS_ERROR_COLOR)
 
     def cancel_action(self):
+        """
+        Clear the canvas and reset to default settings.
+        The clear is recorded as a single undoable action.
+        """
+        self.finish_open()
+        self.reset_canvas()
+        self.commit_history()
+
+    def reset_canvas(self):
         """
         Clear the canvas and reset to default settings.
         Resets color, brush size, and clears redo history.
         """
-        self.screen.fill((255, 255, 255))
+        self.canvas.clear()
+        self.command_log.record(ClearCommand())
+        self.mark_canvas_dirty(self.canvas.rect)
 
         # Reset to default palette color (black)
         default_palette_button = self.palette_button_manager.buttons[0]
@@ -961,6 +1789,7 @@ class UI:
         default_size_button.on_click()
 
         self.redo_button.empty_history()
+        self.command_log.undone.clear()
 
     def fill_area(self):
         """
@@ -998,28 +1827,183 @@ class UI:
             self.brush.rainbow = True
 
         self.brush.color_value = 0
+
+    def change_fill_tolerance(self, delta):
+        """Change the fill tolerance (RGB distance), clamped to the valid range."""
+        self.brush.fill_tolerance = max(0, min(FILL_TOLERANCE_MAX, self.brush.fill_tolerance + delta))
+
+    def toggle_fill_connectivity(self):
+        """Switch the fill between 4-connected and 8-connected regions."""
+        self.brush.fill_connectivity = 8 if self.brush.fill_connectivity == 4 else 4
+
+    def handle_fill_keys(self, event):
+        """
+        Handle the fill option shortcuts.
+        [ and ] change the tolerance, C toggles 4/8 connectivity.
+        """
+        if event.type != pygame.KEYDOWN or pygame.key.get_mods() & pygame.KMOD_CTRL:
+            return
+        if event.key == pygame.K_LEFTBRACKET:
+            self.change_fill_tolerance(-FILL_TOLERANCE_STEP)
+        elif event.key == pygame.K_RIGHTBRACKET:
+            self.change_fill_tolerance(FILL_TOLERANCE_STEP)
+        elif event.key == pygame.K_c:
+            self.toggle_fill_connectivity()
         
+    def reset_history(self):
+        """Forget all history and take the current canvas as the starting state."""
+        self.canvas.discard_history()
+        self.undo_button.empty_history()
+        self.redo_button.empty_history()
+        # The log starts over from the current canvas too
+        self.command_log = CommandLog.for_canvas(self.canvas)
+        self.brush.command_log = self.command_log
+
+    def commit_history(self):
+        """
+        Record the canvas changes made since the last commit as one undo entry.
+        Only the tiles that differ from the previous state are stored.
+        Starting a new action discards the redo history.
+        """
+        entry = self.canvas.take_history_entry()
+        if entry is None:
+            self.command_log.discard()
+            return
+        self.undo_button.push(entry)
+        self.redo_button.empty_history()
+        self.command_log.commit()
+
+    def _apply_history(self, source: UndoRedoButton, target: UndoRedoButton) -> bool:
+        """
+        Restore the tiles of the latest entry of source on the canvas.
+        The tiles they replace are pushed onto target, so the step can be reversed.
+        Returns whether there was an entry to restore.
+        """
+        self.finish_open()
+        # Finish a stroke still in progress so it is undone as a whole
+        if self.drawing:
+            self.commit_history()
+            self.drawing = False
+
+        entry = source.pop()
+        if entry is None:
+            return False
+        target.push(self.canvas.capture(entry))
+        self.canvas.restore(entry)
+        self.mark_canvas_dirty(entry.bounds)
+        return True
+
+    def mark_dirty(self, rect: pygame.Rect):
+        """Schedule a screen area to be pushed to the display on the next frame."""
+        self.dirty_rects.append(pygame.Rect(rect))
+
+    @property
+    def canvas_origin(self) -> Tuple[int, int]:
+        """Screen position of the canvas origin for the current view."""
+        return self.canvas_rect.x - self.view_offset[0], self.canvas_rect.y - self.view_offset[1]
+
+    def screen_to_canvas(self, position: Tuple[int, int]) -> Tuple[int, int]:
+        """Convert a window position to canvas coordinates."""
+        origin_x, origin_y = self.canvas_origin
+        return position[0] - origin_x, position[1] - origin_y
+
+    def draw_stroke_points(self):
+        """Draw the queued mouse samples of the current stroke in one pass."""
+        if self.stroke_points:
+            self.finish_open()
+            with self.frame_profiler.span("fill", "action") if self.brush.fill else NO_SPAN:
+                self.brush.draw_polyline(self.canvas, self.stroke_points)
+            self.stroke_points = []
+
+    def toggle_hud(self):
+        """Show or hide the frame stats HUD (the frame profiler runs while it is shown)."""
+        self.frame_profiler.hud = not self.frame_profiler.hud
+        self.full_redraw = True
+
+    def draw_hud(self) -> pygame.Rect:
+        """Draw the rolling frame stats over the top-left corner of the canvas. Returns the screen area covered."""
+        with self.frame_profiler.span("hud"):
+            rect = pygame.Rect(self.canvas_rect.x + 8, self.canvas_rect.y + 8, HUD_WIDTH, HUD_LINE_HEIGHT * (HUD_LINES + 2) + 8)
+            # The HUD is translucent: put back the canvas it covered last frame first
+            self.composite_canvas(rect)
+            panel = pygame.Surface(rect.size, pygame.SRCALPHA)
+            panel.fill((0, 0, 0, 170))
+            for i, line in enumerate(self.frame_profiler.hud_lines()):
+                panel.blit(self.hud_font.render(line, True, (255, 255, 255)), (6, 4 + i * HUD_LINE_HEIGHT))
+            self.screen.blit(panel, rect)
+        return rect
+
+    def mark_canvas_dirty(self, rect: pygame.Rect):
+        """Schedule a canvas area (in canvas coordinates) to be composited and shown on the next frame."""
+        self.mark_dirty(pygame.Rect(rect).move(self.canvas_origin).clip(self.canvas_rect))
+
+    def composite_canvas(self, rect: Optional[pygame.Rect] = None):
+        """Copy the visible part of the canvas into its window area, or only the part under a screen rect."""
+        rect = self.canvas_rect if rect is None else pygame.Rect(rect).clip(self.canvas_rect)
+        origin_x, origin_y = self.canvas_origin
+        area = rect.move(-origin_x, -origin_y)
+        if not self.canvas.rect.contains(area):
+            self.screen.fill(VIEW_OUTSIDE_COLOR, rect)
+        previous_clip = self.screen.get_clip()
+        self.screen.set_clip(rect)
+        self.canvas.composite(self.screen, (origin_x, origin_y), area)
+        self.screen.set_clip(previous_clip)
+
+    def pan(self, dx: int, dy: int):
+        """Scroll the view over a canvas larger than the window, keeping it in bounds."""
+        max_x = max(0, self.canvas.width - self.canvas_rect.width)
+        max_y = max(0, self.canvas.height - self.canvas_rect.height)
+        offset = (min(max(self.view_offset[0] + dx, 0), max_x), min(max(self.view_offset[1] + dy, 0), max_y))
+        if offset != self.view_offset:
+            self.view_offset = offset
+            self.mark_dirty(self.canvas_rect)
+
+    def handle_view_events(self, event: pygame.event.Event):
+        """
+        Handle the view navigation events.
+        The mouse wheel scrolls (Shift+wheel horizontally), dragging with the
+        middle button pans, and Ctrl+Shift+O opens an image at full size.
+        """
+        if event.type == pygame.MOUSEWHEEL:
+            dx, dy = -event.x * VIEW_PAN_STEP, -event.y * VIEW_PAN_STEP
+            if pygame.key.get_mods() & pygame.KMOD_SHIFT:
+                dx, dy = dy, dx
+            self.pan(dx, dy)
+        elif event.type == pygame.MOUSEMOTION and event.buttons[1]:
+            self.pan(-event.rel[0], -event.rel[1])
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_o:
+            mods = pygame.key.get_mods()
+            if mods & pygame.KMOD_CTRL and mods & pygame.KMOD_SHIFT:
+                self.open_project(full_size=True)
+
+    def history_usage(self) -> dict:
+        """
+        Returns the RAM and disk bytes used by the undo and redo stacks,
+        e.g. {"undo": {"ram": ..., "disk": ...}, "redo": {...}}.
+        """
+        usage = {}
+        for name, button in (("undo", self.undo_button), ("redo", self.redo_button)):
+            ram, disk = button.memory_usage
+            usage[name] = {"ram": ram, "disk": disk}
+        return usage
+
+    @profiled_action("undo")
     def undo(self):
         """
         Undo the last drawing action.
-        Saves current state to redo history before undoing.
+        Saves the tiles it restores to redo history before undoing.
         """
-        redo_screen = self.screen.subsurface(pygame.Rect(200, 0, self.screen_width-200, self.screen_height-50)).copy()
-        self.redo_button.push(redo_screen)
-
-        undo_screen = self.undo_button.pop()
-        pygame.surfarray.blit_array(self.screen.subsurface(pygame.Rect(200, 0, self.screen_width-200, self.screen_height-50)), pygame.surfarray.pixels2d(undo_screen))
+        if self._apply_history(self.undo_button, self.redo_button):
+            self.command_log.undo()
 
+    @profiled_action("redo")
     def redo(self):
         """
         Redo a previously undone action.
-        Saves current state to undo history before redoing.
+        Saves the tiles it restores to undo history before redoing.
         """
-        undo_screen = self.screen.subsurface(pygame.Rect(200, 0, self.screen_width-200, self.screen_height-50)).copy()
-        self.undo_button.push(undo_screen)
-
-        redo_screen = self.redo_button.pop()
-        pygame.surfarray.blit_array(self.screen.subsurface(pygame.Rect(200, 0, self.screen_width-200, self.screen_height-50)), pygame.surfarray.pixels2d(redo_screen))
+        if self._apply_history(self.redo_button, self.undo_button):
+            self.command_log.redo()
 
     def _close_color_picker_callback(self):
         """
@@ -1044,6 +2028,7 @@ class UI:
         # Restore the screen
         self.color_picker.destroy(self.screen)
         self.picking_color = False
+        self.full_redraw = True
 
         self.waiting_for_mouse_release = True
 
@@ -1068,9 +2053,8 @@ class UI:
             # Cancel without saving
             self.color_picker.cancel_picker()
         else:
-            # Open color picker
-            screenshot = self.screen.subsurface(pygame.Rect(200, 0, self.screen_width-200, self.screen_height-50)).copy()
-            self.color_picker.screenshot = screenshot
+            # Open color picker; the "picker open" span ends with its first frame (see run)
+            self.picker_opened_at = time.perf_counter()
             self.color_picker.on_close = self._close_color_picker_callback
             self.color_picker.on_cancel = self._cancel_color_picker_callback
             
@@ -1097,6 +2081,7 @@ class UI:
         # Just restore screen without updating palettes
         self.color_picker.destroy(self.screen)
         self.picking_color = False
+        self.full_redraw = True
 
         self.waiting_for_mouse_release = True
 
@@ -1140,8 +2125,8 @@ class UI:
         self.toolbar_button_manager.add(RectButton(x=212, y=y, width=100, height=50, color=(200,200,200), text="CANC", font=self.font, on_click=self.cancel_action, default_outline=(0,0,0), selected_outline=(0,0,0), shortcut=(pygame.K_n, True, False))) # Ctrl+N
         self.toolbar_button_manager.add(RectButton(x=316, y=y, width=100, height=50, color=(200,200,200), text="FILL", font=self.font, on_click=self.fill_area, default_outline=(0,0,0), selected_outline=(0,0,0), shortcut=(pygame.K_f, False, False))) # F key
         self.toolbar_button_manager.add(RectButton(x=420, y=y, width=100, height=50, color=(200,200,200), text="RGB", font=self.font, on_click=self.rgb_brush, default_outline=(0,0,0), selected_outline=(0,0,0), shortcut=(pygame.K_r, False, False))) # R key
-        self.toolbar_button_manager.add(UndoRedoButton(x=524, y=y, width=50, height=50, color=(200,200,200), text="↩", font=self.font, on_click=self.undo, default_outline=(0,0,0), selected_outline=(0,0,0), enabled=False, shortcut=(pygame.K_z, True, False))) # Ctrl+Z
-        self.toolbar_button_manager.add(UndoRedoButton(x=578, y=y, width=50, height=50, color=(200,200,200), text="↪", font=self.font, on_click=self.redo, default_outline=(0,0,0), selected_outline=(0,0,0), enabled=False, shortcut=(pygame.K_z, True, True))) # Ctrl+Shift+Z
+        self.toolbar_button_manager.add(UndoRedoButton(x=524, y=y, width=50, height=50, color=(200,200,200), text="↩", font=self.font, on_click=self.undo, default_outline=(0,0,0), selected_outline=(0,0,0), enabled=False, shortcut=(pygame.K_z, True, False), memory_budget=self.history_budget)) # Ctrl+Z
+        self.toolbar_button_manager.add(UndoRedoButton(x=578, y=y, width=50, height=50, color=(200,200,200), text="↪", font=self.font, on_click=self.redo, default_outline=(0,0,0), selected_outline=(0,0,0), enabled=False, shortcut=(pygame.K_z, True, True), memory_budget=self.history_budget)) # Ctrl+Shift+Z
         self.toolbar_button_manager.add(RectButton(x=632, y=y, width=50, height=50, color=(200,200,200), text="🎨", font=self.font, on_click=self.pick_color, default_outline=(0,0,0), selected_outline=(0,0,0), shortcut=(pygame.K_p, False, False))) # P key
 
         # Store references to undo/redo buttons
@@ -1192,31 +2177,121 @@ class UI:
         Also draws visual indicators for active fill and rainbow modes.
         """
         palette_rect = pygame.Rect(0, 0, 200, self.screen_height-52)
-        toolbar_rect = pygame.Rect(0, self.screen_height - 52, self.screen_width, 52)
         pygame.draw.rect(self.screen, (150,150,150), palette_rect)
-        pygame.draw.rect(self.screen, (50, 50, 50), toolbar_rect)
+        pygame.draw.rect(self.screen, (50, 50, 50), self.toolbar_rect)
+        self.draw_mode_indicators()
+        self.draw_status()
+
+    def draw_status(self):
+        """Draw the status line in the toolbar, cut to the status area."""
+        pygame.draw.rect(self.screen, (50, 50, 50), self.status_rect)
+        self.status_shown = self.status
+        text, color = self.status
+        if text:
+            txt_surf = self.indicator_font.render(text, True, color)
+            area = pygame.Rect(0, 0, self.status_rect.width, txt_surf.get_height())
+            self.screen.blit(txt_surf, txt_surf.get_rect(midleft=self.status_rect.midleft), area)
+
+    @property
+    def mode_indicator_state(self) -> tuple:
+        """Everything shown by the mode indicators; they need a redraw when this changes."""
+        if self.brush.fill:
+            return ("fill", self.brush.color, self.brush.fill_tolerance, self.brush.fill_connectivity)
+        return ("rainbow",) if self.brush.rainbow else ()
+
+    def draw_mode_indicators(self):
+        """
+        Draw the fill and rainbow mode indicators at the bottom of the sidebar.
+        Clears the indicator area first so they can be redrawn on their own.
+        """
+        pygame.draw.rect(self.screen, (150,150,150), self.indicator_rect)
+        self.indicator_state = self.mode_indicator_state
 
         # Draw fill mode indicator
         if(self.brush.fill):
             pygame.draw.rect(self.screen, (50,50,50), (50, 610, 100, 80), border_radius=5)
             pygame.draw.polygon(self.screen, self.brush.color, ((55,615), (145,615),(120, 635),(100, 640), (80, 635)))
+            for text, y in ((f"TOL {self.brush.fill_tolerance}", 657), (f"{self.brush.fill_connectivity}-WAY", 677)):
+                txt_surf = self.indicator_font.render(text, True, (200, 200, 200))
+                self.screen.blit(txt_surf, txt_surf.get_rect(center=(100, y)))
         
         # Draw rainbow mode indicator
         if(self.brush.rainbow):
             for i, color in enumerate([(255, 0, 0), (255, 165, 0), (255, 255, 0), (0, 255, 0), (0, 0, 255), (75, 0, 130), (238, 130, 238)]):
                 pygame.draw.circle(self.screen, color, (100, 690), 80 - i * 10, width=10, draw_top_right=True, draw_top_left=True)
 
+    def render_frame(self):
+        """
+        Redraw only what changed since the last frame and push just those areas
+        to the display. Falls back to a full redraw and flip when the whole
+        window is invalid (startup, after the picker, exposed window, image open).
+        """
+        span = self.frame_profiler.span
+        for rect in self.brush.take_dirty_rects():
+            self.mark_canvas_dirty(rect)
+
+        if self.full_redraw:
+            with span("composite"):
+                self.composite_canvas()
+            with span("ui rectangles"):
+                self.draw_ui_rectangles()
+            with span("buttons"):
+                self.palette_button_manager.draw_all(self.screen)
+                self.size_changer_button_manager.draw_all(self.screen)
+                self.toolbar_button_manager.draw_all(self.screen)
+            if self.frame_profiler.hud:
+                self.draw_hud()
+            with span("flip"):
+                pygame.display.flip()
+            self.full_redraw = False
+            self.dirty_rects = []
+            return
+
+        rects, self.dirty_rects = [rect for rect in self.dirty_rects if rect], []
+        with span("composite"):
+            for rect in rects:
+                self.composite_canvas(rect)
+
+        with span("buttons"):
+            # Canvas changes under the toolbar's top edge need the toolbar on top again
+            if any(self.toolbar_rect.colliderect(rect) for rect in rects):
+                pygame.draw.rect(self.screen, (50, 50, 50), self.toolbar_rect)
+                self.toolbar_button_manager.draw_all(self.screen)
+                self.size_changer_button_manager.draw_all(self.screen)
+                self.draw_status()
+                rects.append(self.toolbar_rect)
+
+            if self.mode_indicator_state != self.indicator_state:
+                self.draw_mode_indicators()
+                rects.append(self.indicator_rect)
+
+            if self.status != self.status_shown:
+                self.draw_status()
+                rects.append(self.status_rect)
+
+            rects += self.palette_button_manager.draw_changed(self.screen)
+            rects += self.size_changer_button_manager.draw_changed(self.screen)
+            rects += self.toolbar_button_manager.draw_changed(self.screen)
+
+        if self.frame_profiler.hud:
+            rects.append(self.draw_hud())
+
+        if rects:
+            with span("flip"):
+                pygame.display.update(rects)
+
     def select_save_file(self):
         """
         Open a file save dialog for the user to choose save location and filename.
         Returns the selected file path or None if cancelled.
         """
+        from tkinter import Tk, filedialog
         root = Tk()
         root.withdraw()
         file_path = filedialog.asksaveasfilename(
             title="Save as",
             defaultextension=".png",
-            filetypes=[("Image files", "*.png"), ("All files", "*.*")]
+            filetypes=[("Image files", "*.png"), ("Command log", "*" + COMMAND_LOG_EXTENSION), ("All files", "*.*")]
         )
         root.destroy()
         return file_path
@@ -1224,13 +2299,14 @@ class UI:
     def select_image(self):
         """
         Open a file selection dialog for opening image files.
-        Converts non-PNG images to PNG format.
+        The file is decoded as it is (see load_image), nothing is written.
         Returns the file path or None if cancelled.
         """
+        from tkinter import Tk, filedialog
         root = Tk()
         root.withdraw()
             
-        image_extensions = tuple(Image.registered_extensions().keys())
+        image_extensions = IMAGE_EXTENSIONS
 
         # Open file dialog
         file_path = filedialog.askopenfilename(
@@ -1238,62 +2314,133 @@ class UI:
             filetypes=[("Image files", image_extensions)]
         )
 
-        if not file_path:
-            root.iconify()
-            root.destroy()
-            return None
-
-        # Convert to PNG if needed
-        if file_path.lower().endswith(image_extensions) and file_path.lower().endswith('.png'):
-            image = Image.open(file_path)
-            png_file_path = file_path.rsplit('.', 1)[0] + '.png'
-            image.save(png_file_path, 'PNG')
-            root.iconify()
-            root.destroy()
-            return png_file_path
-        else:
-            root.iconify()
-            root.destroy()
-            return file_path
+        root.iconify()
+        root.destroy()
+        return file_path or None
 
     def display_image(self, file_path):
         """
-        Load and display an image file on the canvas.
+        Open an image file on the canvas.
         Scales the image to fit the canvas height while maintaining aspect ratio.
-        Centers the image horizontally.
+        Centers the image horizontally. The image is decoded in the background
+        at about that height (see finish_open).
         """
-        self.cancel_action()
+        self.reset_canvas()
+        # Fit the visible part of the canvas
+        area = pygame.Rect(self.view_offset, self.canvas_rect.size).clip(self.canvas.rect)
+        self.start_open(OpenJob(file_path, image_size(file_path), area, profiler=self.frame_profiler))
 
-        img = pygame.image.load(file_path)
-
-        # Original image dimensions
-        img_width, img_height = img.get_size()
-
-        # Target height and scaling
-        target_height = 720
-        scale_ratio = target_height / img_height
-        new_width = int(img_width * scale_ratio)
-        new_height = target_height
-
-        # Scale the image
-        img = pygame.transform.scale(img, (new_width, new_height))
-
-        # Window dimensions
-        win_width, win_height = self.screen.get_size()
-
-        # Center the image
-        x = (win_width - new_width) // 2
-        y = (win_height - new_height) // 2
-
-        self.screen.blit(img, (x, y))
+    def display_image_full_size(self, file_path):
+        """
+        Open an image at its own resolution as a new drawing.
+        The canvas takes the image size (at least the visible area) and the history starts over.
+        """
+        job = OpenJob(file_path, image_size(file_path), view_size=self.canvas_rect.size, profiler=self.frame_profiler)
+        self.reset_canvas()
+        # Until the worker tells the size of an image with no readable header, the drawing is only the visible area
+        self.canvas = Canvas(*job.drawing_size())
+        self.view_offset = (0, 0)
+        self.reset_history()
+        self.start_open(job)
+
+    def start_open(self, job: OpenJob):
+        """Decode the image of job on the open thread; the frames show its preview, then the image."""
+        job.future = self.open_pool.submit(job.decode)
+        self.open_job = job
+        self.status = (f"Opening {job.name}...", STATUS_COLOR)
+        self.full_redraw = True
+
+    def poll_open(self):
+        """Show the preview of the image being opened as soon as there is one, and the image once decoded."""
+        job = self.open_job
+        if job.preview is not None and not job.preview_shown:
+            job.preview_shown = True
+            self.draw_preview(job)
+        if job.future.done():
+            self.finish_open()
+
+    def draw_preview(self, job: OpenJob):
+        """Draw the preview of an image where the image goes, but only over the visible part of the canvas."""
+        image_rect = job.image_rect()
+        visible = image_rect.clip(pygame.Rect(self.view_offset, self.canvas_rect.size))
+        if not visible.width or not visible.height:
+            return
+        preview = job.preview
+        scale_x, scale_y = preview.get_width() / image_rect.width, preview.get_height() / image_rect.height
+        source = pygame.Rect(int((visible.x - image_rect.x) * scale_x), int((visible.y - image_rect.y) * scale_y),
+                             max(1, round(visible.width * scale_x)), max(1, round(visible.height * scale_y)))
+        part = pygame.transform.scale(preview.subsurface(source.clip(preview.get_rect())), visible.size)
+        self.mark_canvas_dirty(self.canvas.place_image(part, visible.topleft))
+
+    def finish_open(self):
+        """
+        Wait for the image being opened, if any, and draw it in place of its preview.
+        Everything that changes or saves the drawing calls this first, so the
+        preview never ends up in the history, the command log or a file.
+        """
+        job, self.open_job = self.open_job, None
+        if job is None:
+            return
+        try:
+            result = job.future.result()
+        except Exception as e:
+            result = None
+            self.status = (f"Open failed: {e}", STATUS_ERROR_COLOR)
+        else:
+            self.status = (f"Opened {job.name}", STATUS_COLOR)
+        if job.full_size:
+            # The canvas the worker drew the image on is the starting state of the new drawing
+            if result is not None:
+                self.canvas = result
+            else:
+                self.canvas.clear()
+            self.reset_history()
+        else:
+            # Nothing else was drawn since the open started: only the preview goes
+            self.canvas.clear()
+            if result is not None:
+                self.canvas.draw_image(result, job.area)
+        if result is not None:
+            self.command_log.record(ImageCommand(os.path.abspath(job.path), tuple(job.area or job.image_rect())))
+        if job.full_size:
+            self.command_log.commit()
+        else:
+            self.commit_history()
+        self.full_redraw = True
     
     def ask_yes_no(self):
         """
         Show a confirmation dialog when trying to quit.
         Returns False if user wants to quit, True to cancel quit.
         """
+        from tkinter import messagebox
         return not messagebox.askyesno(title="Quit", message="Do you want to quit?")
 
+    def animating(self) -> bool:
+        """Whether the next frame must come at the full frame rate: a stroke or a drag is in progress."""
+        if self.drawing or self.stroke_points:
+            return True
+        if self.picking_color:
+            return self.color_picker._is_dragging or any(
+                isinstance(btn, ColorSlider) and btn._is_dragging
+                for btn in self.color_picker.color_picker_slider_manager.buttons)
+        return False
+
+    def wait_for_input(self, timeout: int = IDLE_TIMEOUT_MS) -> None:
+        """
+        Sleep until the next event, or timeout milliseconds at most. The event is kept
+        for the next frame, which starts as soon as it arrives: no input latency.
+        """
+        event = pygame.event.wait(timeout)
+        if event.type != pygame.NOEVENT:
+            self.pending_events.append(event)
+
+    def poll_events(self) -> List[pygame.event.Event]:
+        """The events of this frame: the one that ended the idle wait, then the queue."""
+        events, self.pending_events = self.pending_events, []
+        events.extend(pygame.event.get())
+        return events
+
     def run(self):
         """
         Main application loop.
@@ -1304,178 +2451,320 @@ class UI:
         icon_path = os.path.join(script_dir, self.icon_name)
         icon_surface = pygame.image.load(icon_path)
         pygame.display.set_icon(icon_surface)
+        self.profiler.mark("icon")
 
         running = True
-        # Define canvas boundaries (drawing area)
-        canvas_x_start = 200
-        canvas_y_start = 0
+        # Define canvas boundaries (drawing area, in window coordinates)
+        canvas_x_start = self.canvas_rect.left
+        canvas_y_start = self.canvas_rect.top
         canvas_x_end = self.screen_width
         canvas_y_end = self.screen_height - 52
 
         self.screen.fill((255,255,255))
+        self.reset_history()
+        if self.session is not None:
+            self.session.begin(self)
 
         while running:
+            self.frame_profiler.begin_frame()
             mouse_pos = pygame.mouse.get_pos()
             mx, my = mouse_pos
 
             # Event handling
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    running = self.ask_yes_no()
+            events = self.poll_events()
+            if self.session is not None:
+                events = self.session.events(events)
+            with self.frame_profiler.span("events"):
+                for event in events:
+                    if event.type != pygame.MOUSEMOTION:
+                        # Anything else may act on the canvas: draw the queued samples first
+                        self.draw_stroke_points()
+
+                    if event.type == pygame.QUIT:
+                        running = self.ask_yes_no()
+
+                    # The window contents were lost (e.g. covered by a dialog)
+                    if event.type in (pygame.WINDOWEXPOSED, pygame.VIDEOEXPOSE):
+                        self.full_redraw = True
+
+                    self.toolbar_button_manager.handle_event(event)
+
+                    if(not self.picking_color):
+                        # Normal mode: handle palette and size buttons
+                        self.palette_button_manager.handle_event(event)
+                        self.size_changer_button_manager.handle_event(event)
+                        self.handle_fill_keys(event)
+                        self.handle_view_events(event)
+                        if event.type == pygame.KEYDOWN and event.key == pygame.K_BACKQUOTE:
+                            self.toggle_hud()
+
+                        # Every mouse sample on the canvas becomes a point of the stroke
+                        pressed = ((event.type == pygame.MOUSEBUTTONDOWN and event.button == 1)
+                                   or (event.type == pygame.MOUSEMOTION and event.buttons[0]))
+                        if pressed and not self.waiting_for_mouse_release:
+                            x, y = event.pos
+                            if canvas_x_start <= x <= canvas_x_end and canvas_y_start <= y <= canvas_y_end:
+                                if not self.brush.enable_last_position:
+                                    self.brush.enable_last_position = True
+                                    self.brush.last_position = self.screen_to_canvas(event.pos)
+
+                                # The stroke is recorded to undo history on release
+                                self.drawing = True
+                                self.stroke_points.append(self.screen_to_canvas(event.pos))
+                            else:
+                                # Left the canvas: the stroke starts over when the mouse comes back
+                                self.draw_stroke_points()
+                                self.brush.enable_last_position = False
 
-                self.toolbar_button_manager.handle_event(event)
+                        if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+                            self.brush.enable_last_position = False
+                            self.brush.color_value = 0
+                            if self.drawing:
+                                self.commit_history()
+                            self.drawing = False
+                            # Clear the waiting flag when mouse is released
+                            if self.waiting_for_mouse_release:
+                                self.waiting_for_mouse_release = False
 
-                if(not self.picking_color):
-                    # Normal mode: handle palette and size buttons
-                    self.palette_button_manager.handle_event(event)
-                    self.size_changer_button_manager.handle_event(event)
-
-                    if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                        if canvas_x_start <= mx <= canvas_x_end and canvas_y_start <= my <= canvas_y_end:
-                            self.brush.enable_last_position = True
-                            self.brush.last_position = (mx, my)
-
-                    if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
-                        self.brush.enable_last_position = False
-                        self.brush.color_value = 0
-                        self.drawing = False
-                        # Clear the waiting flag when mouse is released
-                        if self.waiting_for_mouse_release:
-                            self.waiting_for_mouse_release = False
+                    else:
+                        # Color picker mode: handle picker buttons
+                        self.color_picker.color_picker_button_manager.handle_event(event)
+                        self.color_picker.color_picker_palette_manager.handle_event(event)
+                        self.color_picker.color_picker_slider_manager.handle_event(event)
 
-                else:
-                    # Color picker mode: handle picker buttons
-                    self.color_picker.color_picker_button_manager.handle_event(event)
-                    self.color_picker.color_picker_palette_manager.handle_event(event)
-                    self.color_picker.color_picker_slider_manager.handle_event(event)
-
-                    # Handle slider dragging
-                    if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                        # Check if clicking on any slider
-                        for i, btn in enumerate(self.color_picker.color_picker_slider_manager.buttons):
-                            if isinstance(btn, ColorSlider):
-                                if btn.rect.collidepoint(event.pos):
-                                    btn._is_dragging = True
-                                    btn.update_from_mouse(mx)
+                        # Handle slider dragging
+                        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                            # Check if clicking on any slider
+                            for i, btn in enumerate(self.color_picker.color_picker_slider_manager.buttons):
+                                if isinstance(btn, ColorSlider):
+                                    if btn.rect.collidepoint(event.pos):
+                                        btn._is_dragging = True
+                                        btn.update_from_mouse(mx)
                     
-                    elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
-                        # Stop dragging all sliders
-                        for i, btn in enumerate(self.color_picker.color_picker_slider_manager.buttons):
-                            if isinstance(btn, ColorSlider):
-                                if btn._is_dragging:
-                                    # Save the color when releasing after dragging a slider
-                                    self.color_picker.color = self.color_picker.hover_color
-                                    self.color_picker.new_colors[self.color_picker.row][self.color_picker.col] = self.color_picker.color
+                        elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+                            # Stop dragging all sliders
+                            for i, btn in enumerate(self.color_picker.color_picker_slider_manager.buttons):
+                                if isinstance(btn, ColorSlider):
+                                    if btn._is_dragging:
+                                        # Save the color when releasing after dragging a slider
+                                        self.color_picker.color = self.color_picker.hover_color
+                                        self.color_picker.new_colors[self.color_picker.row][self.color_picker.col] = self.color_picker.color
                                     
-                                    # Update the picker palette button
-                                    picker_button = self.color_picker.color_picker_palette_manager.buttons[self.color_picker.coord]
-                                    picker_button.color = self.color_picker.color
-                                    picker_button.default_outline = self.color_picker.color
+                                        # Update the picker palette button
+                                        picker_button = self.color_picker.color_picker_palette_manager.buttons[self.color_picker.coord]
+                                        picker_button.color = self.color_picker.color
+                                        picker_button.default_outline = self.color_picker.color
                                     
-                                btn._is_dragging = False
-
-                # Drawing logic (only in normal mode)
-                if(not self.picking_color):
-                    if canvas_x_start <= mx <= canvas_x_end and canvas_y_start <= my <= canvas_y_end:
-                        if pygame.mouse.get_pressed()[0] and not self.waiting_for_mouse_release:
-                            if(not self.brush.enable_last_position):
-                                self.brush.enable_last_position = True
-                                self.brush.last_position = (mx, my)
-
-                            # Save to undo history on first draw
-                            if(not self.drawing):
-                                undo_screen = self.screen.subsurface(pygame.Rect(200, 0, self.screen_width-200, self.screen_height-50)).copy()
-                                self.undo_button.push(undo_screen)
-                                if(self.redo_button.history_stack):
-                                    self.redo_button.empty_history()
-                                self.drawing = True
-
-                            self.brush.draw(self.screen, (mx, my))
-
-                    else:
-                        if pygame.mouse.get_pressed()[0]:
-                            self.brush.enable_last_position = False
-
-                # Color picker interaction logic
-                elif self.picking_color:
-                    any_slider_dragging = False
-                    for btn in self.color_picker.color_picker_slider_manager.buttons:
-                        if isinstance(btn, ColorSlider) and btn._is_dragging:
-                            any_slider_dragging = True
-                            btn.update_from_mouse(mx)
-                            break
+                                    btn._is_dragging = False
+
+                    # Color picker interaction logic
+                    if self.picking_color:
+                        any_slider_dragging = False
+                        for btn in self.color_picker.color_picker_slider_manager.buttons:
+                            if isinstance(btn, ColorSlider) and btn._is_dragging:
+                                any_slider_dragging = True
+                                btn.update_from_mouse(mx)
+                                break
                     
-                    if not any_slider_dragging:
-                        picker_button = self.color_picker.color_picker_button_manager.buttons[0]
+                        if not any_slider_dragging:
+                            picker_button = self.color_picker.color_picker_button_manager.buttons[0]
                         
-                        # Picker grid boundaries
-                        picker_left = 200
-                        picker_top = 0
-                        picker_width = 720
-                        picker_height = 720
-                        picker_right = picker_left + picker_width
-                        picker_bottom = picker_top + picker_height
-
-                        # Handle mouse down - start dragging
-                        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                            if picker_left <= event.pos[0] <= picker_right and picker_top <= event.pos[1] <= picker_bottom:
-                                self.color_picker._is_dragging = True
-
-                        # Handle mouse up - confirm selection
-                        elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
-                            if self.color_picker._is_dragging:
-                                self.color_picker._is_dragging = False
-                                self.color_picker.click_picker(self.screen)
-
-                        # Update hover color while dragging or moving
-                        if picker_left <= mx <= picker_right and picker_top <= my <= picker_bottom:
-                            if self.color_picker._is_dragging:
-                                # Convert to local coordinates
-                                local_x = mx - picker_left
-                                local_y = my - picker_top
-
-                                # Get color at pixel
-                                try:
-                                    selected_color = picker_button.image.get_at((local_x, local_y))
-                                    self.color_picker.hover_color = selected_color[0], selected_color[1], selected_color[2]
-                                except (IndexError, pygame.error):
-                                    pass
+                            # Picker grid boundaries
+                            picker_left = 200
+                            picker_top = 0
+                            picker_width = 720
+                            picker_height = 720
+                            picker_right = picker_left + picker_width
+                            picker_bottom = picker_top + picker_height
+
+                            # Handle mouse down - start dragging
+                            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                                if picker_left <= event.pos[0] <= picker_right and picker_top <= event.pos[1] <= picker_bottom:
+                                    self.color_picker._is_dragging = True
+
+                            # Handle mouse up - confirm selection
+                            elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+                                if self.color_picker._is_dragging:
+                                    self.color_picker._is_dragging = False
+                                    self.color_picker.click_picker(self.screen)
+
+                            # Update hover color while dragging or moving
+                            if picker_left <= mx <= picker_right and picker_top <= my <= picker_bottom:
+                                if self.color_picker._is_dragging:
+                                    # Convert to local coordinates
+                                    local_x = mx - picker_left
+                                    local_y = my - picker_top
+
+                                    # Look the color up in the cached picker array (or HSV planes)
+                                    selected_color = picker_button.pick((local_x, local_y))
+                                    if selected_color is not None:
+                                        self.color_picker.hover_color = selected_color
                 
 
+            # The brush draws this frame's samples on the canvas in one pass
+            with self.frame_profiler.span("draw"):
+                self.draw_stroke_points()
+
             # Update all button states
-            self.toolbar_button_manager.update_all()
-            
+            with self.frame_profiler.span("update"):
+                if self.save_jobs:
+                    self.poll_saves()
+                if self.open_job:
+                    self.poll_open()
+                self.toolbar_button_manager.update_all()
+                if(not self.picking_color):
+                    self.palette_button_manager.update_all()
+                    self.size_changer_button_manager.update_all()
+                else:
+                    self.color_picker.color_picker_button_manager.update_all()
+                    self.color_picker.color_picker_palette_manager.update_all()
+                    self.color_picker.color_picker_slider_manager.update_all()
+
             if(not self.picking_color):
-                # Normal mode rendering
-                self.palette_button_manager.update_all()
-                self.size_changer_button_manager.update_all()
-                self.draw_ui_rectangles()
-                
-                self.palette_button_manager.draw_all(self.screen)
-                self.size_changer_button_manager.draw_all(self.screen)
+                # Normal mode rendering: only what changed
+                self.render_frame()
 
             else:
                 # Color picker mode rendering
-                self.color_picker.color_picker_button_manager.update_all()
-                self.color_picker.color_picker_palette_manager.update_all()
-                self.color_picker.color_picker_slider_manager.update_all()
-
-                self.color_picker.update(self.screen)
-                self.color_picker.color_picker_button_manager.draw_all(self.screen)
-                self.color_picker.color_picker_palette_manager.draw_all(self.screen)
-                self.color_picker.color_picker_slider_manager.draw_all(self.screen)
-
-            # Always draw toolbar
-            self.toolbar_button_manager.draw_all(self.screen)
-
-            pygame.display.flip()
-            self.clock.tick(self.fps)
-
+                with self.frame_profiler.span("picker"):
+                    self.color_picker.update(self.screen)
+                    self.color_picker.color_picker_button_manager.draw_all(self.screen)
+                    self.color_picker.color_picker_palette_manager.draw_all(self.screen)
+                    self.color_picker.color_picker_slider_manager.draw_all(self.screen)
+                    self.toolbar_button_manager.draw_all(self.screen)
+                with self.frame_profiler.span("flip"):
+                    pygame.display.flip()
+                if self.picker_opened_at is not None:
+                    self.frame_profiler.record("picker open", "action", self.picker_opened_at, time.perf_counter())
+                    self.picker_opened_at = None
+
+            if self.profiler.enabled:
+                self.profiler.mark("first frame")
+                self.profiler.finish()
+
+            self.frame_profiler.end_frame()
+            if self.session is not None:
+                self.session.end_frame(self)
+                if self.session.finished:
+                    running = False
+
+            with self.frame_profiler.span("wait", "idle"):
+                if self.idle_pacing and not self.animating():
+                    self.wait_for_input(BACKGROUND_POLL_MS if self.save_jobs or self.open_job else IDLE_TIMEOUT_MS)
+                self.clock.tick(self.fps)
+
+        self.finish_open()
+        if self.session is not None:
+            self.session.finish(self)
+        self.frame_profiler.write_trace()
+        # Let running saves finish before exiting
+        self.save_pool.shutdown(wait=True)
+        self.open_pool.shutdown()
         pygame.quit()
         sys.exit()
 
 # --- MAIN ENTRY POINT ---
+def parse_args(argv=None):
+    """Parse the command line options."""
+    parser = argparse.ArgumentParser(description="A simple paint application built with Pygame.")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print the time spent in each startup phase up to the first frame")
+    parser.add_argument("--canvas-size", type=canvas_size, metavar="WxH",
+                        help="size of the drawing in pixels (default: the visible area)")
+    parser.add_argument("--batch-render", metavar="DIR",
+                        help="render the command logs of DIR to PNGs without opening a window, then exit")
+    parser.add_argument("--output", metavar="DIR",
+                        help="where --batch-render writes the PNGs (default: next to the logs)")
+    parser.add_argument("--workers", type=int, metavar="N",
+                        help="worker processes for --batch-render (default: one per CPU)")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record the input of the session to FILE, for --replay")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="play back a session recorded with --record without a window, report frame times and exit")
+    parser.add_argument("--original-timing", action="store_true",
+                        help="with --replay, wait between frames as in the recording instead of running at full speed")
+    parser.add_argument("--fixed-fps", action="store_true",
+                        help="redraw at the full frame rate even when idle, instead of waiting for input")
+    parser.add_argument("--png-compression", type=int, choices=range(10), default=PNG_COMPRESSION_LEVEL, metavar="0-9",
+                        help=f"zlib level of saved PNGs, 0 (fastest) to 9 (smallest) (default: {PNG_COMPRESSION_LEVEL})")
+    parser.add_argument("--png-filter", choices=PNG_FILTERS, default="none",
+                        help="PNG row filter of saved PNGs; adaptive picks the best one per row (default: none)")
+    parser.add_argument("--profile", action="store_true",
+                        help="show the frame stats HUD from the start (toggle it with the ` key)")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write the frame phases and actions to FILE as a Chrome trace (chrome://tracing, Perfetto) on exit")
+    return parser.parse_args(argv)
+
+
+def render_log(source: str, destination: str) -> float:
+    """Replay a command log and save the canvas as a PNG. Returns the seconds it took."""
+    start = time.perf_counter()
+    CommandLog.load(source).replay().save(destination)
+    return time.perf_counter() - start
+
+
+def _init_render_worker():
+    """Process pool initializer: no window, no audio in the render workers."""
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+
+def batch_render(directory: str, output: Optional[str] = None, workers: Optional[int] = None) -> int:
+    """
+    Render every command log of a directory (.paintlog files, or .json scripts
+    written in the same format) to a PNG of the same name, spread over a pool
+    of worker processes. Prints the time of each job and the total.
+    Returns the number of logs that failed.
+    """
+    output = output or directory
+    os.makedirs(output, exist_ok=True)
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith((COMMAND_LOG_EXTENSION, ".json")))
+    start = time.perf_counter()
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker) as pool:
+        jobs = {}
+        for name in names:
+            destination = os.path.join(output, os.path.splitext(name)[0] + ".png")
+            jobs[pool.submit(render_log, os.path.join(directory, name), destination)] = name
+        for job in as_completed(jobs):
+            try:
+                print(f"{jobs[job]}: {job.result() * 1000:.1f} ms")
+            except Exception as e:
+                failures += 1
+                print(f"{jobs[job]}: failed: {e}", file=sys.stderr)
+    print(f"{len(names) - failures}/{len(names)} rendered in {time.perf_counter() - start:.2f} s")
+    return failures
+
+
+def canvas_size(text: str) -> Tuple[int, int]:
+    """Parse a WIDTHxHEIGHT canvas size."""
+    try:
+        width, height = (int(value) for value in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got {text!r}")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError(f"canvas size must be positive, got {text!r}")
+    return width, height
+
+
 if __name__ == "__main__":
-    ui = UI((1280, 770), "Paint Application")
+    args = parse_args()
+    if args.batch_render:
+        sys.exit(1 if batch_render(args.batch_render, args.output, args.workers) else 0)
+    profiler = StartupProfiler(enabled=args.profile_startup)
+    session = None
+    if args.replay:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        session = SessionReplayer(args.replay, args.original_timing)
+        args.canvas_size = session.canvas_size
+    elif args.record:
+        session = SessionRecorder(args.record)
+    frame_profiler = FrameProfiler(trace_path=args.trace, hud=args.profile)
+    ui = UI((1280, 770), "Paint Application", profiler=profiler, canvas_size=args.canvas_size,
+            frame_profiler=frame_profiler)
+    ui.session = session
+    ui.idle_pacing = ui.idle_pacing and not args.fixed_fps
+    ui.png_compression, ui.png_filter = args.png_compression, args.png_filter
     ui.load_buttons()
+    profiler.mark("buttons")
     ui.run()
\ No newline at end of file
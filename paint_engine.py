@@ -0,0 +1,1558 @@
+"""
+The painting engine behind paint.py: the tiled Canvas, the Brush, flood
+fill, undo history and command logs. It only uses offscreen surfaces and
+NumPy arrays, never the display or tkinter, so it can be imported and run
+headless. paint.UI is the window front end on top of it.
+
+    canvas = Canvas(800, 600)
+    brush = Brush(size=6, color=(200, 0, 0))
+    brush.draw_polyline(canvas, [(10, 10), (400, 300), (790, 10)])
+    canvas.save("out.png")
+"""
+from collections import deque
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
+import hashlib
+import json
+import math
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import weakref
+import zlib
+from typing import Callable, ClassVar, Tuple, Optional, List
+import numpy as np
+import pygame
+
+
+# --- FILL ENGINE ---
+FILL_TOLERANCE_STEP = 8
+FILL_TOLERANCE_MAX = 442  # Distance between black and white in RGB space
+
+def _segment_starts(mask: np.ndarray) -> np.ndarray:
+    """Marks the first pixel of every horizontal run of True values in a 2D mask."""
+    starts = mask.copy()
+    starts[:, 1:] &= ~mask[:, :-1]
+    return starts
+
+
+def _run_edges(upper: np.ndarray, lower: np.ndarray,
+               upper_ids: np.ndarray, lower_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the pairs of run ids touching between two rows.
+    Only the first pixel of each overlapping segment produces an edge,
+    since a contiguous overlap always lies in a single run on both rows.
+    """
+    first = _segment_starts(upper & lower)
+    return upper_ids[first], lower_ids[first]
+
+
+def connected_region(mask: np.ndarray, seed: Tuple[int, int], connectivity: int = 4) -> np.ndarray:
+    """Returns the 4- or 8-connected region of a (row, column) boolean mask containing seed."""
+    seeds = np.zeros(mask.shape, dtype=bool)
+    seeds[seed] = True
+    return connected_regions(mask, seeds, connectivity)
+
+
+def label_components(mask: np.ndarray, connectivity: int = 4) -> Tuple[np.ndarray, int]:
+    """
+    Labels the 4- or 8-connected components of a (row, column) boolean mask:
+    0 outside the mask, and one id per component inside it, all below count.
+    Horizontal runs are labelled with a cumulative sum, and runs touching on
+    adjacent rows are merged with a vectorized union-find. Returns (labels, count).
+    """
+    if connectivity not in (4, 8):
+        raise ValueError(f"Connectivity must be 4 or 8, got {connectivity}")
+
+    # Label every horizontal run of the mask
+    starts = _segment_starts(mask)
+    run_ids = np.cumsum(starts, axis=None).reshape(mask.shape) - 1
+    run_count = int(run_ids[-1, -1]) + 1
+
+    # Runs on neighbouring rows that share a column are connected
+    a, b = _run_edges(mask[:-1], mask[1:], run_ids[:-1], run_ids[1:])
+
+    # With 8-connectivity, runs touching diagonally are connected too
+    if connectivity == 8:
+        edges = [(a, b),
+                 _run_edges(mask[:-1, :-1], mask[1:, 1:], run_ids[:-1, :-1], run_ids[1:, 1:]),
+                 _run_edges(mask[:-1, 1:], mask[1:, :-1], run_ids[:-1, 1:], run_ids[1:, :-1])]
+        a = np.concatenate([edge[0] for edge in edges])
+        b = np.concatenate([edge[1] for edge in edges])
+
+    # Vectorized union-find: hook larger roots onto smaller ones, then compress
+    parent = np.arange(run_count)
+    while a.size:
+        root_a, root_b = parent[a], parent[b]
+        pending = root_a != root_b
+        if not pending.any():
+            break
+        a, b = a[pending], b[pending]
+        low = np.minimum(root_a[pending], root_b[pending])
+        high = np.maximum(root_a[pending], root_b[pending])
+        np.minimum.at(parent, high, low)
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+    # A component's id is its root run's id plus one, so 0 stays free for the background
+    labels = np.zeros(mask.shape, dtype=np.int32)
+    labels[mask] = parent[run_ids[mask]] + 1
+    return labels, run_count + 1
+
+
+def connected_regions(mask: np.ndarray, seeds: np.ndarray, connectivity: int = 4) -> np.ndarray:
+    """
+    Returns the 4- or 8-connected regions of a (row, column) boolean mask containing any seed.
+    The seeds' components (see label_components) are expanded back to pixels with a single gather.
+    """
+    if connectivity not in (4, 8):
+        raise ValueError(f"Connectivity must be 4 or 8, got {connectivity}")
+    seeds = seeds & mask
+    if not seeds.any():
+        return np.zeros(mask.shape, dtype=bool)
+    labels, count = label_components(mask, connectivity)
+    in_region = np.zeros(count, dtype=bool)
+    in_region[labels[seeds]] = True
+    return in_region[labels]
+
+
+def color_match_mask(surface: pygame.Surface, color: Tuple[int, int, int], tolerance: int = 0) -> np.ndarray:
+    """
+    Returns a (row, column) mask of the pixels within tolerance of color.
+    Tolerance is a Euclidean RGB distance; 0 matches the exact color only.
+    The mask is computed once over the whole surface.
+    """
+    rgb = pygame.surfarray.pixels3d(surface).transpose(1, 0, 2)
+    distance = np.zeros(rgb.shape[:2], dtype=np.int32)
+    for channel, value in enumerate(color[:3]):
+        diff = rgb[..., channel].astype(np.int32) - value
+        distance += diff * diff
+    return distance <= tolerance * tolerance
+
+
+# --- HISTORY ENGINE ---
+HISTORY_TILE_SIZE = 64
+HISTORY_MEMORY_BUDGET = 64 * 1024 * 1024  # Bytes of RAM per history stack
+HISTORY_COMPRESSION_LEVEL = 1
+
+
+@dataclass
+class HistoryEntry:
+    """
+    The canvas tiles touched by one action.
+    Each tile is keyed by its top-left pixel and holds the pixels to restore.
+    Canvas tiles that were a single color are kept in uniform as (width, height, color).
+    """
+    tiles: dict = field(default_factory=dict)
+    uniform: dict = field(default_factory=dict)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the stored tile pixels."""
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    @property
+    def bounds(self) -> Optional[pygame.Rect]:
+        """Bounding rectangle of the stored tiles, or None for an empty entry."""
+        rects = [pygame.Rect(x, y, *tile.shape) for (x, y), tile in self.tiles.items()]
+        rects += [pygame.Rect(x, y, width, height) for (x, y), (width, height, _) in self.uniform.items()]
+        return rects[0].unionall(rects) if rects else None
+
+    def to_bytes(self) -> bytes:
+        """Serialize and compress the entry."""
+        return zlib.compress(pickle.dumps((self.tiles, self.uniform), protocol=pickle.HIGHEST_PROTOCOL), HISTORY_COMPRESSION_LEVEL)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'HistoryEntry':
+        """Rebuild an entry serialized with to_bytes."""
+        return cls(*pickle.loads(zlib.decompress(data)))
+
+
+@dataclass
+class JournalRecord:
+    """Location of a history entry spilled to the on-disk journal."""
+    offset: int
+    length: int
+
+
+class HistoryStore:
+    """
+    Stack of history entries kept within a memory budget.
+    When the budget is exceeded, the oldest entries are compressed in memory
+    first, then appended to a journal file in a temporary directory.
+    Entries on disk are only read back when popped.
+    The newest entry is always kept uncompressed so the next undo is instant.
+    """
+    def __init__(self, memory_budget: int = HISTORY_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        # Oldest first; each record is a HistoryEntry, compressed bytes or a JournalRecord
+        self._records: List[HistoryEntry | bytes | JournalRecord] = []
+        self._spilled = 0  # Journal records always form the bottom of the stack
+        self._ram_bytes = 0
+        self._journal = None
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    @property
+    def ram_bytes(self) -> int:
+        """Bytes of entry data held in memory."""
+        return self._ram_bytes
+
+    @property
+    def disk_bytes(self) -> int:
+        """Bytes of entry data spilled to the journal."""
+        if not self._spilled:
+            return 0
+        last = self._records[self._spilled - 1]
+        return last.offset + last.length
+
+    def push(self, entry: HistoryEntry) -> None:
+        """Add an entry on top of the stack, compressing or spilling older ones if needed."""
+        self._records.append(entry)
+        self._ram_bytes += entry.nbytes
+        self._enforce_budget()
+
+    def pop(self) -> HistoryEntry | None:
+        """Remove and return the newest entry, reading it back from memory or disk."""
+        if not self._records:
+            return None
+        record = self._records.pop()
+        if isinstance(record, HistoryEntry):
+            self._ram_bytes -= record.nbytes
+            return record
+        if isinstance(record, bytes):
+            self._ram_bytes -= len(record)
+            return HistoryEntry.from_bytes(record)
+
+        # The newest spilled entry is always at the end of the journal
+        self._journal.seek(record.offset)
+        data = self._journal.read(record.length)
+        self._journal.truncate(record.offset)
+        self._spilled -= 1
+        return HistoryEntry.from_bytes(data)
+
+    def clear(self) -> None:
+        """Drop every entry and empty the journal."""
+        self._records = []
+        self._spilled = 0
+        self._ram_bytes = 0
+        if self._journal:
+            self._journal.truncate(0)
+
+    def _enforce_budget(self) -> None:
+        """Compress, then spill, the oldest entries until memory use fits the budget."""
+        newest = len(self._records) - 1
+        for index in range(self._spilled, newest):
+            if self._ram_bytes <= self.memory_budget:
+                return
+            record = self._records[index]
+            if isinstance(record, HistoryEntry):
+                data = record.to_bytes()
+                self._ram_bytes += len(data) - record.nbytes
+                self._records[index] = data
+
+        while self._ram_bytes > self.memory_budget and self._spilled < newest:
+            data = self._records[self._spilled]
+            offset = self.disk_bytes
+            journal = self._open_journal()
+            journal.seek(offset)
+            journal.write(data)
+            self._records[self._spilled] = JournalRecord(offset, len(data))
+            self._ram_bytes -= len(data)
+            self._spilled += 1
+
+    def _open_journal(self):
+        """Create the journal file on first use; it is removed with the store."""
+        if self._journal is None:
+            directory = tempfile.mkdtemp(prefix="paint-history-")
+            self._journal = open(os.path.join(directory, "journal.bin"), "w+b")
+            weakref.finalize(self, self._remove_journal, self._journal, directory)
+        return self._journal
+
+    @staticmethod
+    def _remove_journal(journal, directory: str) -> None:
+        journal.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def changed_tiles(before: np.ndarray, after: np.ndarray, tile_size: int = HISTORY_TILE_SIZE) -> List[Tuple[int, int]]:
+    """
+    Returns the top-left corners of the tiles that differ between two pixel arrays.
+    The comparison and the per-tile reduction are done over the whole array at once.
+    """
+    changed = before != after
+    if not changed.any():
+        return []
+    xs = np.arange(0, changed.shape[0], tile_size)
+    ys = np.arange(0, changed.shape[1], tile_size)
+    per_tile = np.logical_or.reduceat(np.logical_or.reduceat(changed, xs, axis=0), ys, axis=1)
+    return [(int(xs[i]), int(ys[j])) for i, j in np.argwhere(per_tile)]
+
+
+def capture_tiles(pixels: np.ndarray, corners, tile_size: int = HISTORY_TILE_SIZE) -> HistoryEntry:
+    """Copy the given tiles out of a pixel array into a new history entry."""
+    return HistoryEntry({(x, y): pixels[x:x + tile_size, y:y + tile_size].copy() for x, y in corners})
+
+
+# --- IMAGE DECODING ---
+PREVIEW_REDUCTION = 8  # JPEG draft mode decodes at up to 1/8 scale without decoding the full image
+GRAY_PALETTE = [(value, value, value) for value in range(256)]  # For 8-bit grayscale (L) images
+
+
+def image_size(path: str) -> Optional[Tuple[int, int]]:
+    """
+    The size of an image file, read from its header. None when PIL does not
+    know the format: only decoding the image (see load_image) tells its size.
+    """
+    from PIL import Image, UnidentifiedImageError
+    try:
+        with Image.open(path) as image:
+            return image.size
+    except UnidentifiedImageError:
+        return None
+
+
+def fitted_size(size: Tuple[int, int], height: int) -> Tuple[int, int]:
+    """The size of an image of the given size scaled to height, keeping its aspect ratio (as Canvas.draw_image does)."""
+    return int(size[0] * (height / size[1])), height
+
+
+def _importable(image, keep_palette: bool = True):
+    """
+    A PIL image in a mode _to_surface takes as is: RGB, RGBA, L, or P unless
+    keep_palette is false (Image.reduce cannot average palette indices).
+    PIL converts the other modes, and palettes with alpha, in one C pass.
+    """
+    transparency = image.info.get("transparency")
+    if image.mode in ("RGBA", "L") or (image.mode == "RGB" and transparency is None):
+        return image
+    if image.mode == "P" and keep_palette and image.palette.mode == "RGB" and not isinstance(transparency, bytes):
+        return image
+    return image.convert("RGBA" if "A" in image.getbands() or transparency is not None else "RGB")
+
+
+def _to_surface(image) -> pygame.Surface:
+    """
+    A surface made from the pixel buffer of a decoded PIL image, with no
+    per-pixel work in Python. L and P images become 8-bit surfaces with a
+    palette (and their transparent index as color key) instead of being
+    expanded to RGB; the canvas converts them when they are drawn.
+    """
+    image = _importable(image)
+    if image.mode in ("RGB", "RGBA"):
+        return pygame.image.frombuffer(image.tobytes(), image.size, image.mode)
+    surface = pygame.image.frombuffer(image.tobytes(), image.size, "P")
+    if image.mode == "L":
+        surface.set_palette(GRAY_PALETTE)
+    else:
+        palette = image.getpalette()
+        surface.set_palette([tuple(palette[i:i + 3]) for i in range(0, len(palette), 3)])
+    if isinstance(image.info.get("transparency"), int):
+        surface.set_colorkey(image.info["transparency"])
+    return surface
+
+
+def load_image(path: str, height: Optional[int] = None) -> pygame.Surface:
+    """
+    Decode an image file: at full resolution with pygame.image.load, or, with
+    height, scaled to fitted_size for that height. An image taller than that
+    is decoded close to the height instead of at full resolution (JPEG draft
+    mode, then Image.reduce by an integer factor), so a large photo never has
+    to be held in memory at full size.
+    """
+    if height is not None:
+        from PIL import Image, UnidentifiedImageError
+        try:
+            image = Image.open(path)
+        except UnidentifiedImageError:
+            image = None  # Not a format PIL reads: pygame decodes it at full size
+        if image is not None:
+            with image:
+                if image.height > height:
+                    size = image.size
+                    # Only JPEG decoders support it; other formats ignore the request
+                    image.draft("RGB", fitted_size(size, height))
+                    factor = image.height // height
+                    if factor > 1:
+                        image = _importable(image, keep_palette=False).reduce(factor)
+                    return pygame.transform.scale(_to_surface(image), fitted_size(size, height))
+    surface = pygame.image.load(path)
+    return surface if height is None else pygame.transform.scale(surface, fitted_size(surface.get_size(), height))
+
+
+def load_preview(path: str) -> Optional[pygame.Surface]:
+    """
+    A quick low resolution decode of a JPEG file (at 1/PREVIEW_REDUCTION of
+    its size), or None for the formats that have to be decoded fully anyway.
+    """
+    from PIL import Image, UnidentifiedImageError
+    try:
+        image = Image.open(path)
+    except UnidentifiedImageError:
+        return None
+    with image:
+        if image.format != "JPEG":
+            return None
+        image.draft("RGB", (image.width // PREVIEW_REDUCTION, image.height // PREVIEW_REDUCTION))
+        return _to_surface(image)
+
+
+# --- CANVAS ---
+CANVAS_DEPTH = 32
+CANVAS_BACKGROUND = (255, 255, 255)
+CANVAS_TILE_SIZE = 256  # A multiple of HISTORY_TILE_SIZE
+PNG_COMPRESSION_LEVEL = 6
+PNG_FILTERS = ("none", "sub", "up", "average", "paeth", "adaptive")  # Row filter types 0-4, or the best per row
+STROKE_TOLERANCE = 2  # Max distance (px) between a capsule stroke's edge and the stamped stroke's
+CAPSULE_MAX_LENGTH = 1024  # Longer strokes are drawn in pieces
+STROKE_MASK_COLORS = 255  # Segments per stroke mask (8-bit palette, 0 is transparent)
+STAMP_CACHE_SIZE = 256  # Enough for a whole rainbow cycle at one brush size
+STAMP_SUPERSAMPLING = 4  # Samples per pixel side for antialiased stamps
+
+
+def segment_distance(point, start, end) -> float:
+    """Distance from a point to the segment between start and end."""
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    length_sq = dx * dx + dy * dy
+    t = 0 if length_sq == 0 else max(0, min(1, ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / length_sq))
+    return math.hypot(point[0] - start[0] - t * dx, point[1] - start[1] - t * dy)
+
+
+def _png_chunk(file, kind: bytes, data: bytes) -> None:
+    """Write one PNG chunk (length, type, data, CRC)."""
+    file.write(struct.pack(">I", len(data)) + kind + data)
+    file.write(struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+
+def png_filter_rows(rows: np.ndarray, prior: np.ndarray, png_filter: str = "none", bpp: int = 3) -> np.ndarray:
+    """
+    Apply a PNG row filter to (n, stride) uint8 rows, prior being the row above
+    the first one (zeros at the top of the image). Returns the (n, stride + 1)
+    filtered rows, each starting with its filter type. "adaptive" picks the
+    filter with the smallest sum of absolute differences for every row, like libpng.
+    """
+    count, stride = rows.shape
+    raw = rows.astype(np.int16)
+    up = np.empty_like(raw)
+    up[0] = prior
+    up[1:] = raw[:-1]
+    left = np.zeros_like(raw)
+    left[:, bpp:] = raw[:, :-bpp]
+    up_left = np.zeros_like(raw)
+    up_left[:, bpp:] = up[:, :-bpp]
+
+    def predicted(kind: int) -> np.ndarray:
+        if kind == 0:
+            return raw
+        if kind == 1:
+            return raw - left
+        if kind == 2:
+            return raw - up
+        if kind == 3:
+            return raw - ((left + up) >> 1)
+        # Paeth: the neighbour closest to left + up - up_left
+        pa, pb, pc = np.abs(up - up_left), np.abs(left - up_left), np.abs(left + up - 2 * up_left)
+        return raw - np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+
+    out = np.empty((count, stride + 1), dtype=np.uint8)
+    if png_filter == "adaptive":
+        candidates = np.stack([predicted(kind).astype(np.uint8) for kind in range(5)])
+        scores = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+        best = scores.argmin(axis=0)
+        out[:, 0] = best
+        out[:, 1:] = candidates[best, np.arange(count)]
+    else:
+        kind = PNG_FILTERS.index(png_filter)
+        out[:, 0] = kind
+        out[:, 1:] = predicted(kind).astype(np.uint8)
+    return out
+
+
+def write_png(path: str, width: int, height: int, strips, compression: int = PNG_COMPRESSION_LEVEL,
+              png_filter: str = "none", progress: Optional[Callable[[float], None]] = None) -> None:
+    """
+    Write an 8-bit RGB PNG from an iterable of (rows, width, 3) uint8 strips.
+    Strips are compressed as they come, so the whole image never has to be in memory.
+    compression is the zlib level (0-9) and png_filter one of PNG_FILTERS;
+    progress is called with the fraction of rows written after each strip.
+    """
+    if png_filter not in PNG_FILTERS:
+        raise ValueError(f"unknown PNG filter {png_filter!r}, expected one of {', '.join(PNG_FILTERS)}")
+    compressor = zlib.compressobj(compression)
+    prior = np.zeros(width * 3, dtype=np.uint8)
+    written = 0
+    with open(path, "wb") as file:
+        file.write(b"\x89PNG\r\n\x1a\n")
+        _png_chunk(file, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        for strip in strips:
+            rows = strip.reshape(strip.shape[0], -1)
+            data = compressor.compress(png_filter_rows(rows, prior, png_filter).tobytes())
+            prior = rows[-1]
+            if data:
+                _png_chunk(file, b"IDAT", data)
+            written += strip.shape[0]
+            if progress is not None:
+                progress(written / height)
+        _png_chunk(file, b"IDAT", compressor.flush())
+        _png_chunk(file, b"IEND", b"")
+
+
+@lru_cache(maxsize=STAMP_CACHE_SIZE)
+def brush_stamp(radius: int, color: Tuple[int, int, int], antialias: bool = False) -> Tuple[pygame.Surface, int]:
+    """
+    Returns a pre-rendered filled circle and the offset to blit it at:
+    blitting it at (x - offset, y - offset) paints the same pixels as
+    pygame.draw.circle(surface, color, (x, y), radius). Plain stamps are
+    32-bit with a color key (RLE acceleration is slower to blit at brush
+    sizes); antialiased ones have a one pixel margin with alpha coverage.
+    Rainbow strokes change color on every stamp, so the cache keeps only
+    the most recently used stamps.
+    """
+    if antialias:
+        size = 2 * radius + 2
+        # Coverage of each pixel, from a grid of samples per pixel
+        samples = (np.arange(size * STAMP_SUPERSAMPLING) + 0.5) / STAMP_SUPERSAMPLING - (radius + 1)
+        inside = (samples[:, None] ** 2 + samples[None, :] ** 2) <= radius * radius
+        coverage = inside.reshape(size, STAMP_SUPERSAMPLING, size, STAMP_SUPERSAMPLING).mean(axis=(1, 3))
+        stamp = pygame.Surface((size, size), pygame.SRCALPHA, 32)
+        stamp.fill(color)
+        pygame.surfarray.pixels_alpha(stamp)[...] = np.rint(coverage * 255).astype(np.uint8)
+        return stamp, radius + 1
+
+    key = (255, 255, 255) if tuple(color[:3]) == (0, 0, 0) else (0, 0, 0)
+    stamp = pygame.Surface((2 * radius, 2 * radius), 0, CANVAS_DEPTH)
+    stamp.fill(key)
+    pygame.draw.circle(stamp, color, (radius, radius), radius)
+    stamp.set_colorkey(key)
+    return stamp, radius
+
+
+@dataclass
+class Canvas:
+    """
+    The drawing, stored as a sparse grid of tiles instead of one big surface.
+    A tile is either a 32-bit surface or, when all its pixels are the same,
+    just their mapped color. Tiles that were never touched are not stored at
+    all and show the background, so memory follows the painted area and every
+    operation only visits the tiles it changes.
+
+    Writes go through _writable and _set_uniform, which keep the state of a
+    tile before its first change since the last history commit
+    (copy-on-write). Undo entries are built from those pre-images.
+    """
+    width: int
+    height: int
+    background: Tuple[int, int, int] = CANVAS_BACKGROUND
+    tile_size: int = CANVAS_TILE_SIZE
+    tiles: dict = field(default_factory=dict, init=False)  # (column, row) -> Surface or mapped color
+    _pre_images: dict = field(default_factory=dict, init=False)
+    _format: pygame.Surface = field(default=None, init=False)
+
+    def __post_init__(self):
+        # Reference surface for the pixel format shared by all tiles
+        self._format = pygame.Surface((1, 1), 0, CANVAS_DEPTH)
+        self.background_value = self.map_rgb(self.background)
+
+    @property
+    def rect(self) -> pygame.Rect:
+        """The whole canvas, in canvas coordinates."""
+        return pygame.Rect(0, 0, self.width, self.height)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the allocated tile surfaces."""
+        return sum(tile.get_width() * tile.get_height() * 4 for tile in self.tiles.values() if isinstance(tile, pygame.Surface))
+
+    def map_rgb(self, color) -> int:
+        """Returns the pixel value of a color in the canvas format."""
+        return self._format.map_rgb(color)
+
+    def unmap_rgb(self, value: int) -> pygame.Color:
+        """Returns the color of a pixel value in the canvas format."""
+        return self._format.unmap_rgb(value)
+
+    # Tile addressing
+    def tile_key(self, position: Tuple[int, int]) -> Tuple[int, int]:
+        """Returns the key of the tile containing a canvas position."""
+        return position[0] // self.tile_size, position[1] // self.tile_size
+
+    def tile_rect(self, key: Tuple[int, int]) -> pygame.Rect:
+        """Returns the area of a tile in canvas coordinates (edge tiles are smaller)."""
+        x, y = key[0] * self.tile_size, key[1] * self.tile_size
+        return pygame.Rect(x, y, min(self.tile_size, self.width - x), min(self.tile_size, self.height - y))
+
+    def tile_keys(self, rect: pygame.Rect) -> List[Tuple[int, int]]:
+        """Returns the keys of the tiles overlapping an area of the canvas."""
+        rect = pygame.Rect(rect).clip(self.rect)
+        if not rect.width or not rect.height:
+            return []
+        columns = range(rect.left // self.tile_size, (rect.right - 1) // self.tile_size + 1)
+        rows = range(rect.top // self.tile_size, (rect.bottom - 1) // self.tile_size + 1)
+        return [(column, row) for row in rows for column in columns]
+
+    def state(self, key: Tuple[int, int]) -> pygame.Surface | int:
+        """Returns the surface of a tile, or its mapped color when it is uniform."""
+        return self.tiles.get(key, self.background_value)
+
+    # Copy-on-write
+    def _record(self, key: Tuple[int, int], moved: bool = False) -> None:
+        """Keep the state of a tile before its first change since the last history commit."""
+        if key not in self._pre_images:
+            state = self.state(key)
+            self._pre_images[key] = state if moved or not isinstance(state, pygame.Surface) else state.copy()
+
+    def _writable(self, key: Tuple[int, int], record: bool = True) -> pygame.Surface:
+        """Returns the surface of a tile to draw on, allocating it if the tile is uniform."""
+        if record:
+            self._record(key)
+        state = self.state(key)
+        if isinstance(state, pygame.Surface):
+            return state
+        surface = pygame.Surface(self.tile_rect(key).size, 0, CANVAS_DEPTH)
+        surface.fill(state)
+        self.tiles[key] = surface
+        return surface
+
+    def _set_uniform(self, key: Tuple[int, int], value: int, record: bool = True) -> None:
+        """Make a whole tile one color, freeing its surface."""
+        if record:
+            # The surface is dropped, so it can be kept as is
+            self._record(key, moved=True)
+        if value == self.background_value:
+            self.tiles.pop(key, None)
+        else:
+            self.tiles[key] = value
+
+    def _compact(self, key: Tuple[int, int]) -> None:
+        """Store a tile as its color if all its pixels turned out to be the same."""
+        state = self.state(key)
+        if isinstance(state, pygame.Surface):
+            pixels = pygame.surfarray.pixels2d(state)
+            value = int(pixels[0, 0])
+            uniform = not (pixels != value).any()
+            del pixels
+            if uniform:
+                self._set_uniform(key, value, record=False)
+
+    # Reading pixels
+    def value_at(self, position: Tuple[int, int]) -> int:
+        """Returns the pixel value at a canvas position."""
+        key = self.tile_key(position)
+        state = self.state(key)
+        if isinstance(state, pygame.Surface):
+            tile_rect = self.tile_rect(key)
+            return state.get_at_mapped((position[0] - tile_rect.x, position[1] - tile_rect.y))
+        return state
+
+    def get_at(self, position: Tuple[int, int]) -> pygame.Color:
+        """Returns the color at a canvas position."""
+        return self.unmap_rgb(self.value_at(position))
+
+    def read(self, rect: pygame.Rect) -> np.ndarray:
+        """Returns a copy of the pixel values of an area, indexed [x, y]."""
+        rect = pygame.Rect(rect).clip(self.rect)
+        out = np.empty((rect.width, rect.height), dtype=np.uint32)
+        for key in self.tile_keys(rect):
+            tile_rect = self.tile_rect(key)
+            part = tile_rect.clip(rect)
+            target = out[part.x - rect.x:part.right - rect.x, part.y - rect.y:part.bottom - rect.y]
+            state = self.state(key)
+            if isinstance(state, pygame.Surface):
+                target[...] = pygame.surfarray.pixels2d(state)[part.x - tile_rect.x:part.right - tile_rect.x,
+                                                               part.y - tile_rect.y:part.bottom - tile_rect.y]
+            else:
+                target[...] = state
+        return out
+
+    def read_rgb(self, rect: pygame.Rect) -> np.ndarray:
+        """Returns the RGB values of an area as a (width, height, 3) uint8 array."""
+        values = self.read(rect)
+        return np.stack([(values >> shift) & 0xFF for shift in self._format.get_shifts()[:3]], axis=-1).astype(np.uint8)
+
+    def snapshot(self) -> np.ndarray:
+        """Returns a copy of all the canvas pixel values, indexed [x, y]."""
+        return self.read(self.rect)
+
+    def digest(self) -> str:
+        """SHA-256 of the canvas size and RGB pixels: equal for equal drawings, however their tiles are stored."""
+        digest = hashlib.sha256(f"{self.width}x{self.height}".encode())
+        for y in range(0, self.height, self.tile_size):
+            digest.update(self.to_array(pygame.Rect(0, y, self.width, self.tile_size)).tobytes())
+        return digest.hexdigest()
+
+    def to_array(self, rect: Optional[pygame.Rect] = None) -> np.ndarray:
+        """Returns the RGB pixels of the canvas (or of an area) as a (height, width, 3) uint8 image array."""
+        return self.read_rgb(self.rect if rect is None else rect).transpose(1, 0, 2)
+
+    @classmethod
+    def from_array(cls, pixels: np.ndarray, background: Tuple[int, int, int] = CANVAS_BACKGROUND) -> 'Canvas':
+        """A canvas holding an RGB (height, width, 3) uint8 image array, as its starting state."""
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        height, width = pixels.shape[:2]
+        canvas = cls(width, height, background)
+        canvas.place_image(pygame.image.frombuffer(pixels.tobytes(), (width, height), "RGB"), (0, 0))
+        canvas.discard_history()
+        return canvas
+
+    @classmethod
+    def load(cls, path: str, background: Tuple[int, int, int] = CANVAS_BACKGROUND) -> 'Canvas':
+        """A canvas of the size of an image file, holding the image as its starting state."""
+        image = load_image(path)
+        canvas = cls(*image.get_size(), background)
+        canvas.place_image(image, (0, 0))
+        canvas.discard_history()
+        return canvas
+
+    # Drawing
+    def clear(self) -> None:
+        """Reset every tile to the background color."""
+        for key in list(self.tiles):
+            self._set_uniform(key, self.background_value)
+
+    def draw_circle(self, color, center: Tuple[int, int], radius: int, antialias: bool = False) -> pygame.Rect:
+        """Draw a filled circle on the tiles under it, blitting the cached brush stamp. Returns the canvas area changed."""
+        stamp, offset = brush_stamp(radius, tuple(color[:3]), antialias)
+        x, y = center[0] - offset, center[1] - offset
+        size = stamp.get_width()
+        bounds = pygame.Rect(x, y, size, size)
+        key = (x // self.tile_size, y // self.tile_size)
+        if key == ((x + size - 1) // self.tile_size, (y + size - 1) // self.tile_size) and self.rect.contains(bounds):
+            keys = (key,)  # Most stamps fall inside a single tile
+        else:
+            bounds = bounds.clip(self.rect)
+            keys = self.tile_keys(bounds)
+        value = None if antialias else self.map_rgb(color)
+        for key in keys:
+            if self.tiles.get(key, self.background_value) == value:
+                continue  # Already that color everywhere
+            self._writable(key).blit(stamp, (x - key[0] * self.tile_size, y - key[1] * self.tile_size))
+        return bounds if bounds.width and bounds.height else pygame.Rect(center, (0, 0))
+
+    def draw_stamps(self, color, centers, radius: int, antialias: bool = False) -> pygame.Rect:
+        """
+        Draw filled circles of one color and radius at several centers, blitting
+        the cached brush stamp. Stamps are grouped by tile and drawn with one
+        Surface.blits call per tile. Returns the canvas area changed.
+        """
+        stamp, offset = brush_stamp(radius, tuple(color[:3]), antialias)
+        value = None if antialias else self.map_rgb(color)
+        size, tile_size, canvas_rect = stamp.get_width(), self.tile_size, self.rect
+        per_tile = {}
+        changed = []
+        for x, y in centers:
+            x, y = x - offset, y - offset
+            bounds = pygame.Rect(x, y, size, size)
+            key = (x // tile_size, y // tile_size)
+            if key == ((x + size - 1) // tile_size, (y + size - 1) // tile_size) and canvas_rect.contains(bounds):
+                keys = (key,)
+            else:
+                bounds = bounds.clip(canvas_rect)
+                if not bounds.width or not bounds.height:
+                    continue
+                keys = self.tile_keys(bounds)
+            changed.append(bounds)
+            for key in keys:
+                per_tile.setdefault(key, []).append((x, y))
+
+        for key, positions in per_tile.items():
+            if self.state(key) == value:
+                continue  # Already that color everywhere
+            tile_x, tile_y = self.tile_rect(key).topleft
+            self._writable(key).blits([(stamp, (x - tile_x, y - tile_y)) for x, y in positions], doreturn=False)
+        return changed[0].unionall(changed) if changed else pygame.Rect(centers[0] if centers else (0, 0), (0, 0))
+
+    def draw_capsule(self, color, start: Tuple[int, int], end: Tuple[int, int], radius: int) -> pygame.Rect:
+        """
+        Draw the shape swept by a circle moving from start to end: a thick line
+        with round caps. The shape is rasterized once (two circles and a polygon)
+        into an 8-bit mask and blitted onto the tiles under it, whatever the
+        length. Matches stamping a circle at every pixel of the segment to
+        within STROKE_TOLERANCE px of its edge. Returns the canvas area changed.
+        """
+        if tuple(start) == tuple(end):
+            return self.draw_circle(color, start, radius)
+        return self.draw_stroke([start, end], [color], radius)
+
+    def draw_stroke(self, points, colors, radius: int) -> pygame.Rect:
+        """
+        Draw a polyline of capsules (see draw_capsule): segment i goes from
+        points[i] to points[i + 1] in colors[i], later segments over earlier
+        ones. The segments share one mask (a palette entry per segment), so
+        all the mouse samples of a frame cost one blit per tile. Long or
+        sprawling strokes are split to keep the mask small. Returns the
+        canvas area changed.
+        """
+        segments = []
+        for start, end, color in zip(points, points[1:], colors):
+            dx, dy = end[0] - start[0], end[1] - start[1]
+            pieces = max(1, math.ceil(math.hypot(dx, dy) / CAPSULE_MAX_LENGTH))
+            # A capsule is the union of the capsules of its pieces
+            cuts = [(start[0] + dx * i // pieces, start[1] + dy * i // pieces) for i in range(pieces + 1)]
+            segments.extend((cuts[i], cuts[i + 1], color) for i in range(pieces))
+
+        changed = []
+        chunk, chunk_bounds = [], None
+        for segment in segments:
+            segment_bounds = pygame.Rect(segment[0], (1, 1)).union(pygame.Rect(segment[1], (1, 1)))
+            if chunk:
+                grown = chunk_bounds.union(segment_bounds)
+                if len(chunk) == STROKE_MASK_COLORS or max(grown.size) > CAPSULE_MAX_LENGTH:
+                    changed.append(self._draw_segments(chunk, radius))
+                    chunk, grown = [], segment_bounds
+                chunk_bounds = grown
+            else:
+                chunk_bounds = segment_bounds
+            chunk.append(segment)
+        if chunk:
+            changed.append(self._draw_segments(chunk, radius))
+        return changed[0].unionall(changed) if changed else pygame.Rect(points[0] if points else (0, 0), (0, 0))
+
+    def _draw_segments(self, segments, radius: int) -> pygame.Rect:
+        """Rasterize (start, end, color) capsules into one 8-bit mask and blit it onto the tiles it reaches."""
+        xs = [point[0] for start, end, _ in segments for point in (start, end)]
+        ys = [point[1] for start, end, _ in segments for point in (start, end)]
+        bounds = pygame.Rect(min(xs) - radius, min(ys) - radius,
+                             max(xs) - min(xs) + 2 * radius + 1, max(ys) - min(ys) + 2 * radius + 1)
+
+        # The mask is never clipped: pygame's polygon fill changes with clipping,
+        # so drawing the body tile by tile would not line up across tile edges
+        mask = pygame.Surface(bounds.size, 0, 8)
+        mask.set_colorkey(0)
+        # Body edges at radius - 0.5 cover the same 2 * radius pixels as the caps
+        half_width = max(radius - 0.5, 0)
+        drawn = []
+        for index, (start, end, color) in enumerate(segments, 1):
+            mask.set_palette_at(index, color)
+            local_start = (start[0] - bounds.x, start[1] - bounds.y)
+            local_end = (end[0] - bounds.x, end[1] - bounds.y)
+            drawn.append(pygame.draw.circle(mask, index, local_start, radius))
+            drawn.append(pygame.draw.circle(mask, index, local_end, radius))
+            dx, dy = end[0] - start[0], end[1] - start[1]
+            length = math.hypot(dx, dy)
+            if length:
+                nx, ny = -dy / length * half_width, dx / length * half_width
+                body = [(local_start[0] + nx, local_start[1] + ny), (local_end[0] + nx, local_end[1] + ny),
+                        (local_end[0] - nx, local_end[1] - ny), (local_start[0] - nx, local_start[1] - ny)]
+                drawn.append(pygame.draw.polygon(mask, index, body))
+
+        values = {self.map_rgb(color) for _, _, color in segments}
+        value = values.pop() if len(values) == 1 else None
+        changed = drawn[0].unionall(drawn).move(bounds.topleft).clip(self.rect)
+        for key in self.tile_keys(changed):
+            if value is not None and self.state(key) == value:
+                continue  # Already that color everywhere
+            tile_rect = self.tile_rect(key)
+            # Skip the tiles of the bounding box the stroke does not reach (long diagonals)
+            reach = radius + math.hypot(*tile_rect.size) / 2
+            if all(segment_distance(tile_rect.center, start, end) > reach for start, end, _ in segments):
+                continue
+            self._writable(key).blit(mask, (bounds.x - tile_rect.x, bounds.y - tile_rect.y))
+        return changed
+
+    def place_image(self, image: pygame.Surface, position: Tuple[int, int]) -> pygame.Rect:
+        """Copy an image onto the canvas at full resolution, tile by tile. Returns the canvas area covered."""
+        area = pygame.Rect(position, image.get_size()).clip(self.rect)
+        for key in self.tile_keys(area):
+            tile_rect = self.tile_rect(key)
+            self._writable(key).blit(image, (position[0] - tile_rect.x, position[1] - tile_rect.y))
+            self._compact(key)
+        return area
+
+    def draw_image(self, image: pygame.Surface, area: Optional[pygame.Rect] = None) -> pygame.Rect:
+        """
+        Draw an image scaled to the height of an area of the canvas (the whole
+        canvas by default), keeping its aspect ratio, centered in that area.
+        Returns the canvas area covered.
+        """
+        area = self.rect if area is None else pygame.Rect(area)
+        img_width, img_height = image.get_size()
+        if img_height != area.height:
+            scale_ratio = area.height / img_height
+            image = pygame.transform.scale(image, (int(img_width * scale_ratio), area.height))
+        return self.place_image(image, image.get_rect(center=area.center).topleft)
+
+    def flood_fill(self, position: Tuple[int, int], color, tolerance: int = 0, connectivity: int = 4) -> Optional[pygame.Rect]:
+        """
+        Fill the region connected to position, one tile at a time.
+        Each tile is labelled once with label_components; the fill then
+        spreads from tile to tile as component ids, seeded by the components
+        it reached on the edges of the neighbouring tiles, so a winding region
+        that enters a tile many times never solves it again. Pixels are
+        written at the end. Uniform tiles inside the region stay uniform, so
+        filling a large empty canvas does not allocate anything. Returns the
+        canvas area changed, None when nothing changed or position is off
+        the canvas.
+        """
+        if not self.rect.collidepoint(position):
+            return None
+        orig = self.value_at(position)
+        fill = self.map_rgb(color)
+        if orig == fill and tolerance == 0:
+            return None
+        orig_rgb = tuple(self.unmap_rgb(orig))[:3]
+
+        def matches(value: int) -> bool:
+            rgb = self.unmap_rgb(value)
+            return sum((a - b) ** 2 for a, b in zip(rgb[:3], orig_rgb)) <= tolerance * tolerance
+
+        columns = (self.width - 1) // self.tile_size + 1
+        rows = (self.height - 1) // self.tile_size + 1
+        labels = {}  # Component labels of each visited tile, from its pixels before the fill
+        selected = {}  # Whether each component of a visited tile is in the region, indexed by label
+        pending = {}  # Seeds of each queued tile: (index, values) pairs on its labels
+        queue = deque()
+
+        def send(key, index, values):
+            """Add seeds to a tile and queue it."""
+            if not (0 <= key[0] < columns and 0 <= key[1] < rows):
+                return
+            if key not in pending:
+                pending[key] = []
+                queue.append(key)
+            pending[key].append((index, values))
+
+        start_rect = self.tile_rect(self.tile_key(position))
+        send(self.tile_key(position), (position[1] - start_rect.y, position[0] - start_rect.x), True)
+        while queue:
+            key = queue.popleft()
+            seeds = pending.pop(key)
+
+            if key not in labels:
+                tile_rect = self.tile_rect(key)
+                state = self.state(key)
+                if isinstance(state, pygame.Surface):
+                    mask = (pygame.surfarray.pixels2d(state).T == orig) if tolerance == 0 \
+                        else color_match_mask(state, orig_rgb, tolerance)
+                    labels[key], count = label_components(mask, connectivity)
+                else:
+                    # A uniform tile is one component, or none: no need to allocate its labels
+                    labels[key], count = np.broadcast_to(np.int32(matches(state)), (tile_rect.height, tile_rect.width)), 2
+                selected[key] = np.zeros(count, dtype=bool)
+            tile_labels, tile_selected = labels[key], selected[key]
+
+            # The components the seeds reach that are not in the region yet
+            reached = np.concatenate([np.atleast_1d(np.asarray(tile_labels[index])[values]) for index, values in seeds])
+            reached = reached[(reached > 0) & ~tile_selected[reached]]
+            if not reached.size:
+                continue
+            tile_selected[reached] = True
+            new = np.zeros_like(tile_selected)
+            new[reached] = True
+
+            # Seed the neighbouring tiles with the new components' pixels on the shared edges
+            column, row = key
+            for edge, neighbour, index in ((np.s_[:, 0], (column - 1, row), np.s_[:, -1]),
+                                           (np.s_[:, -1], (column + 1, row), np.s_[:, 0]),
+                                           (np.s_[0, :], (column, row - 1), np.s_[-1, :]),
+                                           (np.s_[-1, :], (column, row + 1), np.s_[0, :])):
+                values = new[tile_labels[edge]]
+                if values.any():
+                    if connectivity == 8:
+                        # Diagonal neighbours across the edge touch too
+                        grown = values.copy()
+                        grown[1:] |= values[:-1]
+                        grown[:-1] |= values[1:]
+                        values = grown
+                    send(neighbour, index, values)
+            if connectivity == 8:
+                for corner, neighbour, index in (((0, 0), (column - 1, row - 1), (-1, -1)),
+                                                 ((0, -1), (column + 1, row - 1), (-1, 0)),
+                                                 ((-1, 0), (column - 1, row + 1), (0, -1)),
+                                                 ((-1, -1), (column + 1, row + 1), (0, 0))):
+                    if new[tile_labels[corner]]:
+                        send(neighbour, index, True)
+
+        rects = []
+        for key, tile_selected in selected.items():
+            if not tile_selected.any():
+                continue
+            tile_rect = self.tile_rect(key)
+            region = tile_selected[labels[key]]
+            if region.all():
+                self._set_uniform(key, fill)
+                rects.append(tile_rect)
+                continue
+            pygame.surfarray.pixels2d(self._writable(key)).T[region] = fill
+            ys = np.flatnonzero(region.any(axis=1))
+            xs = np.flatnonzero(region.any(axis=0))
+            rects.append(pygame.Rect(tile_rect.x + xs[0], tile_rect.y + ys[0], xs[-1] - xs[0] + 1, ys[-1] - ys[0] + 1))
+        return rects[0].unionall(rects) if rects else None
+
+    # Output
+    def composite(self, target: pygame.Surface, position: Tuple[int, int], area: Optional[pygame.Rect] = None) -> None:
+        """
+        Draw the canvas, or only an area of it (in canvas coordinates), onto target
+        with the canvas origin at position. Uniform tiles are drawn as fills.
+        """
+        area = self.rect if area is None else pygame.Rect(area).clip(self.rect)
+        for key in self.tile_keys(area):
+            tile_rect = self.tile_rect(key)
+            part = tile_rect.clip(area)
+            destination = (position[0] + part.x, position[1] + part.y)
+            state = self.state(key)
+            if isinstance(state, pygame.Surface):
+                target.blit(state, destination, part.move(-tile_rect.x, -tile_rect.y))
+            else:
+                target.fill(self.unmap_rgb(state), pygame.Rect(destination, part.size))
+
+    def to_surface(self) -> pygame.Surface:
+        """Returns the whole canvas as a single surface."""
+        surface = pygame.Surface((self.width, self.height), 0, CANVAS_DEPTH)
+        self.composite(surface, (0, 0))
+        return surface
+
+    def copy(self) -> 'Canvas':
+        """
+        A copy of the drawing, without its history. Only painted tiles are
+        copied, and the copy shares no surface with this canvas, so it can be
+        read (e.g. saved) from another thread while drawing goes on.
+        """
+        canvas = Canvas(self.width, self.height, self.background, self.tile_size)
+        canvas.tiles = {key: state.copy() if isinstance(state, pygame.Surface) else state
+                        for key, state in self.tiles.items()}
+        return canvas
+
+    def save(self, path: str, compression: int = PNG_COMPRESSION_LEVEL, png_filter: str = "none",
+             progress: Optional[Callable[[float], None]] = None) -> None:
+        """
+        Save the canvas to an image file (format from the extension).
+        PNG files are written one row of tiles at a time, with the given
+        compression level and row filter (see write_png).
+        """
+        if path.lower().endswith(".png"):
+            strips = (self.read_rgb(pygame.Rect(0, y, self.width, self.tile_size)).transpose(1, 0, 2)
+                      for y in range(0, self.height, self.tile_size))
+            write_png(path, self.width, self.height, strips, compression, png_filter, progress)
+        else:
+            pygame.image.save(self.to_surface(), path)
+            if progress is not None:
+                progress(1.0)
+
+    # History
+    def discard_history(self) -> None:
+        """Forget the pre-images: the current canvas becomes the starting state."""
+        self._pre_images = {}
+
+    def take_history_entry(self) -> Optional[HistoryEntry]:
+        """
+        Returns an entry restoring the canvas as it was at the last commit,
+        or None if nothing changed. Only the sub-tiles that differ are stored,
+        and tiles that were uniform before are stored as their color.
+        """
+        entry = HistoryEntry()
+        for key, before in self._pre_images.items():
+            after = self.state(key)
+            tile_rect = self.tile_rect(key)
+            if not isinstance(before, pygame.Surface):
+                if isinstance(after, pygame.Surface):
+                    if not (pygame.surfarray.pixels2d(after) != before).any():
+                        continue
+                elif after == before:
+                    continue
+                entry.uniform[tile_rect.topleft] = (tile_rect.width, tile_rect.height, before)
+                continue
+
+            before_pixels = pygame.surfarray.array2d(before)
+            after_pixels = self.read(tile_rect)
+            blocks = capture_tiles(before_pixels, changed_tiles(before_pixels, after_pixels))
+            for (x, y), block in blocks.tiles.items():
+                entry.tiles[(tile_rect.x + x, tile_rect.y + y)] = block
+        self._pre_images = {}
+        return entry if entry.tiles or entry.uniform else None
+
+    def capture(self, entry: HistoryEntry) -> HistoryEntry:
+        """Returns an entry holding the current state of the areas an entry would restore."""
+        current = HistoryEntry()
+        for (x, y), (width, height, _) in entry.uniform.items():
+            state = self.state(self.tile_key((x, y)))
+            if isinstance(state, pygame.Surface):
+                current.tiles[(x, y)] = pygame.surfarray.array2d(state)
+            else:
+                current.uniform[(x, y)] = (width, height, state)
+        for (x, y), block in entry.tiles.items():
+            current.tiles[(x, y)] = self.read(pygame.Rect((x, y), block.shape))
+        return current
+
+    def restore(self, entry: HistoryEntry) -> None:
+        """Write the areas of a history entry back, without recording them as a change."""
+        for (x, y), (_, _, value) in entry.uniform.items():
+            self._set_uniform(self.tile_key((x, y)), value, record=False)
+        for (x, y), block in entry.tiles.items():
+            key = self.tile_key((x, y))
+            tile_rect = self.tile_rect(key)
+            width, height = block.shape
+            pixels = pygame.surfarray.pixels2d(self._writable(key, record=False))
+            pixels[x - tile_rect.x:x - tile_rect.x + width, y - tile_rect.y:y - tile_rect.y + height] = block
+            del pixels
+            self._compact(key)
+
+
+# --- BRUSH CLASS ---
+@dataclass
+class Brush:
+    """
+    Represents the drawing brush with configurable size, color, and drawing modes.
+    Supports normal drawing, fill mode, and rainbow mode.
+    """
+    size: int = field(default=8)
+    color: Tuple[int, int, int] = field(default=(0, 0, 0))
+    enable_last_position: bool = field(default=False, init=False)
+    last_position: Tuple[int, int] = field(default=(0,0), init=False)
+    fill: bool = field(default=False)
+    fill_tolerance: int = field(default=0)
+    fill_connectivity: int = field(default=4)
+    rainbow: bool = field(default=False)
+    prev_color: Tuple[int, int, int] = None
+
+    color_value: int = field(default=0, init=False)
+    dirty_rects: List[pygame.Rect] = field(default_factory=list, init=False)
+    command_log: Optional['CommandLog'] = field(default=None, init=False, repr=False)
+
+    def set_color(self, color):
+        """Set the brush color."""
+        self.color = color
+
+    def set_size(self, size):
+        """Set the brush size (radius in pixels)."""
+        self.size = size
+
+    def take_dirty_rects(self) -> List[pygame.Rect]:
+        """Return the areas changed since the last call and forget them."""
+        rects, self.dirty_rects = self.dirty_rects, []
+        return rects
+
+    def floodFill(self, canvas, position, fill_color, tolerance=0, connectivity=4):
+        """
+        Vectorized flood fill, tile by tile (see Canvas.flood_fill).
+        Pixels within `tolerance` (RGB distance) of the clicked color are
+        filled too, and `connectivity` selects 4- or 8-connected regions.
+        """
+        # Change cursor to indicate processing (there is none when rendering headless)
+        windowed = pygame.display.get_surface() is not None
+        if windowed:
+            pygame.mouse.set_cursor(2)
+        changed = canvas.flood_fill(position, fill_color, tolerance, connectivity)
+        if changed:
+            self.dirty_rects.append(changed)
+        if windowed:
+            pygame.mouse.set_cursor(pygame.Cursor(11))
+
+    def floodFillScanline(self, surface, position, fill_color):
+        """
+        Reference scanline flood fill on a plain surface, one pixel at a time.
+        Kept to check the vectorized floodFill pixel-for-pixel.
+        """
+        arr = pygame.surfarray.pixels2d(surface)
+        x, y = position
+        w, h = arr.shape
+        orig_color = arr[x, y]
+        fill_color_mapped = surface.map_rgb(fill_color)
+
+        # Don't fill if already the target color
+        if orig_color == fill_color_mapped:
+            return
+
+        stack = [(x, y)]
+        
+        while stack:
+            nx, ny = stack.pop()
+            if nx < 0 or nx >= w or ny < 0 or ny >= h or arr[nx, ny] != orig_color:
+                continue
+
+            # Find west and east boundaries of the scanline
+            west = nx
+            east = nx
+            while west > 0 and arr[west - 1, ny] == orig_color:
+                west -= 1
+            while east < w - 1 and arr[east + 1, ny] == orig_color:
+                east += 1
+
+            # Fill the entire scanline at once for efficiency
+            arr[west:east + 1, ny] = fill_color_mapped
+
+            # Check north/south neighbors only at segment boundaries to avoid duplicates
+            if ny > 0:
+                in_segment = False
+                for i in range(west, east + 1):
+                    is_target = arr[i, ny - 1] == orig_color
+                    if is_target and not in_segment:
+                        stack.append((i, ny - 1))
+                        in_segment = True
+                    elif not is_target:
+                        in_segment = False
+                        
+            if ny < h - 1:
+                in_segment = False
+                for i in range(west, east + 1):
+                    is_target = arr[i, ny + 1] == orig_color
+                    if is_target and not in_segment:
+                        stack.append((i, ny + 1))
+                        in_segment = True
+                    elif not is_target:
+                        in_segment = False
+
+    def rainbowColor(self):
+        """
+        Returns a rainbow color based on the current color_value.
+        Cycles through red -> yellow -> green -> cyan -> blue -> magenta.
+        """
+        step = (self.color_value // 256) % 6
+        pos = self.color_value % 256
+        if step == 0:
+            return (255, pos, 0)
+        if step == 1:
+            return (255-pos, 255, 0)
+        if step == 2:
+            return (0, 255, pos)
+        if step == 3:
+            return (0, 255-pos, 255)
+        if step == 4:
+            return (pos, 0, 255)
+        if step == 5:
+            return (255, 0, 255-pos)
+
+    def round_line(self, canvas, start):
+        """
+        Draws a smooth line between the last position and current position.
+        Prevents gaps when mouse moves quickly. The segment is drawn as a single
+        capsule, so its cost does not grow with the distance moved.
+        """
+        if start == self.last_position:
+            return
+        self.dirty_rects.append(canvas.draw_capsule(self.color, self.last_position, start, self.size))
+
+    def round_line_stamps(self, canvas, start):
+        """
+        Reference for round_line: stamps one circle per pixel of distance.
+        Kept to check the capsule stroke against (see STROKE_TOLERANCE).
+        """
+        x_axis = self.last_position[0]-start[0]
+        y_axis = self.last_position[1]-start[1]
+        dist = max(abs(x_axis), abs(y_axis))
+        stamps = []
+        for i in range(dist):
+            x = int(start[0]+float(i)/dist*x_axis)
+            y = int(start[1]+float(i)/dist*y_axis)
+            stamps.append((x, y))
+        if stamps:
+            self.dirty_rects.append(canvas.draw_stamps(self.color, stamps, self.size))
+
+    def draw(self, canvas, mouse_position):
+        """
+        Main drawing method. Handles fill mode, rainbow mode, and normal drawing.
+        Positions are in canvas coordinates.
+        """
+        if(self.fill):
+            # Fill mode: flood fill the clicked area
+            inside = canvas.rect.collidepoint(mouse_position)
+            if inside and (canvas.get_at(mouse_position)[:3] != self.color or self.fill_tolerance > 0):
+                self.floodFill(canvas, mouse_position, self.color, self.fill_tolerance, self.fill_connectivity)
+
+        elif(self.rainbow):
+            # Rainbow mode: cycle through colors automatically
+            self.color_value = (self.color_value + 8) % (256 * 6)
+            self.color = self.rainbowColor()
+            
+        else:
+            # Normal mode: draw a circle at mouse position
+            self.dirty_rects.append(canvas.draw_circle(self.color, mouse_position, self.size))
+
+        # Draw smooth line if we have a previous position
+        if(self.enable_last_position):
+            self.round_line(canvas, mouse_position)
+
+        self.last_position = mouse_position
+
+    def draw_polyline(self, canvas, points):
+        """
+        Draws the mouse samples of one frame, as draw would one by one, but
+        with the whole stroke through them rasterized in a single pass
+        (see Canvas.draw_stroke). Positions are in canvas coordinates.
+        """
+        if not points:
+            return
+        if self.command_log is not None:
+            self.command_log.record_stroke(self, points)
+        if self.fill:
+            for point in points:
+                self.draw(canvas, point)
+            return
+
+        vertices, colors = [], []
+        if self.enable_last_position:
+            vertices.append(self.last_position)
+        for point in points:
+            if self.rainbow:
+                self.color_value = (self.color_value + 8) % (256 * 6)
+                self.color = self.rainbowColor()
+            if vertices and point == vertices[-1]:
+                continue
+            if vertices:
+                colors.append(self.color)
+            vertices.append(point)
+        if colors:
+            self.dirty_rects.append(canvas.draw_stroke(vertices, colors, self.size))
+        elif not self.rainbow:
+            # A click without movement: the rainbow brush only draws lines
+            self.dirty_rects.append(canvas.draw_circle(self.color, vertices[-1], self.size))
+        self.last_position = points[-1]
+
+
+# --- COMMAND LOG ---
+COMMAND_LOG_VERSION = 1
+COMMAND_LOG_EXTENSION = ".paintlog"
+
+
+@dataclass
+class StrokeCommand:
+    """
+    A brush stroke: the mouse samples (canvas coordinates) drawn with
+    Brush.draw_polyline, continuing from start when the stroke was already
+    under way. Rainbow strokes keep the color phase they started at instead
+    of a color.
+    """
+    points: List[Tuple[int, int]]
+    size: int
+    color: Optional[Tuple[int, int, int]] = None
+    rainbow_phase: Optional[int] = None
+    start: Optional[Tuple[int, int]] = None
+    kind: ClassVar[str] = "stroke"
+
+    def apply(self, canvas, brush) -> None:
+        brush.fill, brush.size = False, self.size
+        brush.rainbow = self.rainbow_phase is not None
+        if brush.rainbow:
+            brush.color_value = self.rainbow_phase
+        else:
+            brush.color = self.color
+        brush.enable_last_position = self.start is not None
+        if self.start is not None:
+            brush.last_position = self.start
+        brush.draw_polyline(canvas, self.points)
+
+
+@dataclass
+class FillCommand:
+    """
+    A click of the fill brush at position. A drag in fill mode also draws
+    a line from start, like Brush.draw does.
+    """
+    position: Tuple[int, int]
+    color: Tuple[int, int, int]
+    tolerance: int = 0
+    connectivity: int = 4
+    size: int = 8
+    start: Optional[Tuple[int, int]] = None
+    kind: ClassVar[str] = "fill"
+
+    def apply(self, canvas, brush) -> None:
+        brush.fill, brush.rainbow = True, False
+        brush.color, brush.size = self.color, self.size
+        brush.fill_tolerance, brush.fill_connectivity = self.tolerance, self.connectivity
+        brush.enable_last_position = self.start is not None
+        brush.last_position = self.position if self.start is None else self.start
+        brush.draw(canvas, self.position)
+
+
+@dataclass
+class ClearCommand:
+    """The whole canvas cleared to its background."""
+    kind: ClassVar[str] = "clear"
+
+    def apply(self, canvas, brush) -> None:
+        canvas.clear()
+
+
+@dataclass
+class ImageCommand:
+    """
+    An image file drawn into an area of the canvas (see Canvas.draw_image).
+    The image is referenced, not embedded: a saved log stores its path
+    relative to the log file, so a log moved together with its images still
+    replays, but the replay only matches while the file is there, unchanged.
+    """
+    path: str
+    area: Tuple[int, int, int, int]
+    kind: ClassVar[str] = "image"
+
+    def apply(self, canvas, brush) -> None:
+        area = pygame.Rect(self.area)
+        canvas.draw_image(load_image(self.path, area.height), area)
+
+    def relative_to(self, directory: str) -> 'ImageCommand':
+        """The command with its path relative to directory (kept absolute when on another Windows drive)."""
+        try:
+            return replace(self, path=os.path.relpath(self.path, directory))
+        except ValueError:
+            return self
+
+    def resolved(self, directory: str) -> 'ImageCommand':
+        """The command with a relative path taken from directory (absolute paths of older logs stay as they are)."""
+        return replace(self, path=os.path.normpath(os.path.join(directory, self.path)))
+
+
+COMMAND_TYPES = {command.kind: command for command in (StrokeCommand, FillCommand, ClearCommand, ImageCommand)}
+
+
+@dataclass
+class CommandLog:
+    """
+    The drawing as the list of actions that made it, instead of pixels.
+    Commands are recorded as they happen and grouped into actions when the UI
+    commits its undo history, so undo and redo move whole actions between
+    actions and undone. Replaying the actions on a blank canvas of the same
+    size rebuilds the drawing pixel for pixel (see replay). Image paths are
+    absolute in memory and relative to the file in a saved log.
+    """
+    width: int
+    height: int
+    background: Tuple[int, int, int] = CANVAS_BACKGROUND
+    actions: List[list] = field(default_factory=list)
+    undone: List[list] = field(default_factory=list, init=False)
+    pending: list = field(default_factory=list, init=False)
+
+    @classmethod
+    def for_canvas(cls, canvas) -> 'CommandLog':
+        """An empty log for a blank canvas of the size and background of canvas."""
+        return cls(canvas.width, canvas.height, canvas.background)
+
+    @property
+    def commands(self) -> list:
+        """Every command that is part of the drawing, oldest first."""
+        return [command for action in self.actions for command in action] + self.pending
+
+    def record(self, command) -> None:
+        """Add a command to the action in progress."""
+        self.pending.append(command)
+
+    def record_stroke(self, brush, points) -> None:
+        """
+        Record the samples of brush.draw_polyline, before it draws them.
+        A stroke continuing the previous command is merged into it, and
+        repeated samples are dropped (the rainbow phase counts every sample).
+        Nothing else is simplified: dropping samples that are nearly in line
+        would move the stamps of the stroke, and replay has to be pixel exact.
+        """
+        start = tuple(brush.last_position) if brush.enable_last_position else None
+        points = [tuple(point) for point in points]
+        if brush.fill:
+            for point in points:
+                self.record(FillCommand(point, tuple(brush.color), brush.fill_tolerance, brush.fill_connectivity,
+                                        brush.size, None if start in (None, point) else start))
+                start = point if brush.enable_last_position else None
+            return
+
+        if brush.rainbow:
+            command = StrokeCommand(points, brush.size, rainbow_phase=brush.color_value, start=start)
+        else:
+            kept = [point for previous, point in zip([start] + points, points) if point != previous]
+            command = StrokeCommand(kept or points[-1:], brush.size, tuple(brush.color), start=start)
+
+        last = self.pending[-1] if self.pending else None
+        if (isinstance(last, StrokeCommand) and start is not None and start == last.points[-1]
+                and (last.size, last.color) == (command.size, command.color)
+                and (last.rainbow_phase is None) == (command.rainbow_phase is None)
+                and (last.rainbow_phase is None
+                     or (last.rainbow_phase + 8 * len(last.points)) % (256 * 6) == command.rainbow_phase)):
+            if command.rainbow_phase is None:
+                last.points.extend(point for point in command.points if point != last.points[-1])
+            else:
+                last.points.extend(command.points)
+            return
+        self.record(command)
+
+    def commit(self) -> None:
+        """Close the action in progress; a new action discards the undone ones."""
+        if self.pending:
+            self.actions.append(self.pending)
+            self.pending = []
+            self.undone.clear()
+
+    def discard(self) -> None:
+        """Forget the commands of the action in progress (they changed nothing)."""
+        self.pending = []
+
+    def undo(self) -> None:
+        """Move the latest action to the undone ones."""
+        if self.actions:
+            self.undone.append(self.actions.pop())
+
+    def redo(self) -> None:
+        """Move the latest undone action back into the drawing."""
+        if self.undone:
+            self.actions.append(self.undone.pop())
+
+    def to_json(self, directory: Optional[str] = None) -> dict:
+        """
+        The drawing as plain data: canvas size, background and the commands of
+        each action. With directory, image paths are made relative to it.
+        """
+        def fields(command):
+            if directory is not None and isinstance(command, ImageCommand):
+                command = command.relative_to(directory)
+            return dict(vars(command), kind=command.kind)
+
+        return {
+            "version": COMMAND_LOG_VERSION,
+            "width": self.width,
+            "height": self.height,
+            "background": list(self.background),
+            "actions": [[fields(command) for command in action]
+                        for action in self.actions + ([self.pending] if self.pending else [])],
+        }
+
+    @classmethod
+    def from_json(cls, data: dict, directory: Optional[str] = None) -> 'CommandLog':
+        """Rebuild a log written by to_json, taking relative image paths from directory."""
+        if data.get("version") != COMMAND_LOG_VERSION:
+            raise ValueError(f"unsupported command log version: {data.get('version')!r}")
+
+        def command(fields):
+            fields = dict(fields)
+            kind = COMMAND_TYPES[fields.pop("kind")]
+            # JSON turns tuples into lists
+            for name, value in fields.items():
+                if isinstance(value, list):
+                    fields[name] = [tuple(v) for v in value] if value and isinstance(value[0], list) else tuple(value)
+            command = kind(**fields)
+            if directory is not None and isinstance(command, ImageCommand):
+                command = command.resolved(directory)
+            return command
+
+        return cls(data["width"], data["height"], tuple(data["background"]),
+                   [[command(fields) for fields in action] for action in data["actions"]])
+
+    def dumps(self, path: Optional[str] = None) -> str:
+        """The log as compact JSON text, as save writes it to path (image paths relative to its directory)."""
+        directory = None if path is None else os.path.dirname(os.path.abspath(path))
+        return json.dumps(self.to_json(directory), separators=(",", ":"))
+
+    def save(self, path: str) -> None:
+        """Write the log as compact JSON."""
+        with open(path, "w") as file:
+            file.write(self.dumps(path))
+
+    @classmethod
+    def load(cls, path: str) -> 'CommandLog':
+        """Read a log written by save."""
+        with open(path) as file:
+            return cls.from_json(json.load(file), os.path.dirname(os.path.abspath(path)))
+
+    def replay(self, canvas=None):
+        """
+        Rebuild the drawing: apply every command, in order, on a blank canvas
+        (a new Canvas of the log's size unless one is given) with a fresh
+        Brush. Returns the canvas.
+        """
+        canvas = Canvas(self.width, self.height, self.background) if canvas is None else canvas
+        brush = Brush()
+        for command in self.commands:
+            command.apply(canvas, brush)
+            brush.take_dirty_rects()
+        return canvas